@@ -0,0 +1,264 @@
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+import pymongo
+
+# Offline benchmark of map.py against synthetic catalogs.
+#
+#   python benchmark.py --sizes 10,100,1000,5000 --output bench.json
+#   python benchmark.py --mongo-uri mongodb://localhost:27017
+#
+# Without --mongo-uri the app runs against mongomock (pip install mongomock).
+# With --mongo-uri it uses that server and DROPS its mazette database, so only
+# point it at a throwaway local mongod.
+
+PHASES = [
+    "init_session_cold",
+    "init_session_warm",
+    "production_plan",
+    "save_unchanged",
+    "save_changed",
+    "flush_writes",
+    "generate_pdf_checklist",
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark map.py on synthetic catalogs")
+    parser.add_argument("--sizes", default="10,100,1000,5000", help="comma separated catalog sizes")
+    parser.add_argument("--items", type=int, default=3, help="items per product")
+    parser.add_argument("--tasks", type=int, default=2, help="tasks per product")
+    parser.add_argument("--subtasks", type=int, default=2, help="subtasks per item and per task")
+    parser.add_argument("--orders", type=int, default=40, help="order lines per day")
+    parser.add_argument("--todos", type=int, default=5, help="general todos per day")
+    parser.add_argument("--edits", type=float, default=0.01, help="share of products edited before the changed save")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongo-uri", help="use this server instead of mongomock")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    return parser.parse_args()
+
+def connect(args):
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+        return None
+
+    import mongomock
+    import mongomock.collection
+
+    os.environ["MONGO_URI"] = "mongodb://mongomock"
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: client
+
+    # mongomock emits no command events, count collection calls as round trips instead.
+    # Its methods call each other (update_one goes through bulk_write paths, find_one
+    # through find), so only the outermost call is counted.
+    active = threading.local()
+    def counted(name, method):
+        def wrapper(self, *args, **kwargs):
+            if getattr(active, "busy", False):
+                return method(self, *args, **kwargs)
+            stats = app.current_run_stats()
+            if stats is not None:
+                stats["commands"][name] += 1
+            active.busy = True
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                active.busy = False
+        return wrapper
+
+    # mongomock has no change streams, fail like a standalone mongod so the app polls the counters
+    def watch(self, *args, **kwargs):
+        raise pymongo.errors.OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+    mongomock.collection.Collection.watch = watch
+
+    for name in ["find", "find_one", "find_one_and_update", "insert_one", "insert_many", "update_one",
+                 "replace_one", "delete_many", "bulk_write", "aggregate", "count_documents"]:
+        setattr(mongomock.collection.Collection, name, counted(name, getattr(mongomock.collection.Collection, name)))
+    return client
+
+class DeferredPrefetch:
+    # Stands in for the day prefetch pool: a day loads when a phase picks it up, on the
+    # benchmark's thread, so its queries count in that phase and mongomock is never
+    # called from two threads at once
+    def __init__(self, func, *args):
+        self.call = lambda: func(*args)
+        self.value = None
+
+    def done(self):
+        return False
+
+    def result(self):
+        if self.value is None:
+            self.value = self.call()
+        return self.value
+
+class DeferredLoader:
+    def submit(self, func, *args):
+        return DeferredPrefetch(func, *args)
+
+def synthetic_catalog(rng, size, args):
+    element_ids = iter(range(size * (args.items + args.tasks) * (args.subtasks + 1)))
+    products = []
+    for p in range(size):
+        products.append({
+            "name": f"Produit {p:05d}",
+            "items": [{
+                "id": f"{next(element_ids):024x}",
+                "name": f"bac {i}",
+                "capacity": rng.randint(1, 20),
+                "subtasks": [{"id": f"{next(element_ids):024x}", "name": f"préparer {i}.{s}"} for s in range(args.subtasks)],
+            } for i in range(args.items)],
+            "tasks": [{
+                "id": f"{next(element_ids):024x}",
+                "name": f"tâche {t}",
+                "subtasks": [{"id": f"{next(element_ids):024x}", "name": f"étape {t}.{s}"} for s in range(args.subtasks)],
+            } for t in range(args.tasks)],
+        })
+    return products
+
+def synthetic_orders(rng, products, args):
+    names = [product["name"] for product in products]
+    return {day: [{"Produit": rng.choice(names), "Quantité": rng.randint(1, 60)} for _ in range(args.orders)] for day in app.DAYS}
+
+def seed(db, rng, size, args):
+    for collection in ["products", "checklists", "general_todos", "completions", "counters"]:
+        db[collection].drop()
+    products = synthetic_catalog(rng, size, args)
+    db.products.insert_many(products)
+    for day, items in synthetic_orders(rng, products, args).items():
+        db.checklists.insert_one({"session_key": day, "items": items})
+        db.general_todos.insert_many([{"session_key": day, "task": f"{day} tâche {t}", "active": True} for t in range(args.todos)])
+    return products
+
+def reset_process():
+    app.st.session_state.clear()
+    app.product_catalog.clear()
+    app.product_index.clear()
+    app.build_plan.clear()
+    app.cached_pdf_checklist.clear()
+    app.st.session_state.session_key = app.DAYS[0]
+
+def measure(func, trace_memory):
+    # tracemalloc slows everything down, so timed runs and memory runs are separate
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with app.profiled_run(measure_bytes=True) as stats:
+        func()
+    elapsed = (time.perf_counter() - start) * 1000
+    peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    tracemalloc.stop()
+    return {
+        "ms": elapsed,
+        "mongo_commands": sum(stats["commands"].values()),
+        "commands": dict(stats["commands"]),
+        "bytes_sent": stats["bytes_sent"],
+        "bytes_received": stats["bytes_received"],
+        "peak_kib": peak / 1024,
+    }
+
+def edit_products(rng, share):
+    names = sorted(app.st.session_state.products)
+    for name in rng.sample(names, max(1, int(len(names) * share))):
+        product = app.edit_product(name)
+        product["tasks"].append({"id": app.new_element_id(), "name": "nouvelle tâche", "subtasks": []})
+
+def run_once(db, rng, size, args, trace_memory=False):
+    seed(db, rng, size, args)
+    reset_process()
+    day = app.st.session_state.session_key
+    queue = app.write_queue()
+    results = {}
+
+    results["init_session_cold"] = measure(app.init_session, trace_memory)
+    results["init_session_warm"] = measure(app.init_session, trace_memory)
+
+    def expand_all_days():
+        app.build_plan.clear()
+        for plan_day in app.DAYS:
+            app.ensure_day(plan_day)
+            app.production_plan(plan_day)
+    results["production_plan"] = measure(expand_all_days, trace_memory)
+
+    results["save_unchanged"] = measure(app.save_current_session, trace_memory)
+
+    checklist = app.st.session_state[f"{day}_checklist"]
+    app.st.session_state[f"{day}_checklist"] = pd.concat([checklist, checklist.head(1)], ignore_index=True)
+    edit_products(rng, args.edits)
+    results["save_changed"] = measure(app.save_current_session, trace_memory)
+    results["flush_writes"] = measure(lambda: app.flush_write_queue(queue), trace_memory)
+
+    def render_all_pdfs():
+        for pdf_day in app.DAYS:
+            app.ensure_day(pdf_day)
+            _, todos, plan = app.pdf_inputs(pdf_day)
+            app.generate_pdf_checklist(pdf_day, todos, plan)
+    results["generate_pdf_checklist"] = measure(render_all_pdfs, trace_memory)
+    return results
+
+def summarize(runs, memory_run):
+    summary = {}
+    for phase in PHASES:
+        samples = [run[phase] for run in runs]
+        summary[phase] = {
+            "ms_median": statistics.median(sample["ms"] for sample in samples),
+            "ms_min": min(sample["ms"] for sample in samples),
+            "mongo_commands": samples[-1]["mongo_commands"],
+            "commands": samples[-1]["commands"],
+            "bytes_sent": samples[-1]["bytes_sent"],
+            "bytes_received": samples[-1]["bytes_received"],
+            "peak_kib": memory_run[phase]["peak_kib"],
+        }
+    return summary
+
+def main():
+    global app
+    args = parse_args()
+    client = connect(args)
+
+    # Every phase reads Mongo, never a snapshot left behind by an earlier run
+    os.environ["MAZETTE_SNAPSHOT"] = ""
+    import map as app
+    # The report has the numbers, the per-run profiling lines would only drown the progress table
+    logging.getLogger("mazette.profiling").setLevel(logging.WARNING)
+    # The background flusher is not used, flush_writes is timed on this thread
+    app.WRITE_FLUSH_SECONDS = 3600
+    # Other days are then loaded and counted in production_plan, where they are first used
+    app.day_loader = DeferredLoader
+    db = client.mazette if client is not None else app.db
+
+    report = {
+        "backend": "mongod" if args.mongo_uri else "mongomock",
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "mongo_uri")},
+        "results": [],
+    }
+    if not args.mongo_uri:
+        report["notes"] = ["bytes_sent and bytes_received are always 0 under mongomock, which emits no command events"]
+        print("mongomock: byte counts are not measured and stay at 0", file=sys.stderr)
+    for size in [int(size) for size in args.sizes.split(",")]:
+        rng = random.Random(args.seed)
+        runs = [run_once(db, rng, size, args) for _ in range(args.repeat)]
+        memory_run = run_once(db, rng, size, args, trace_memory=True)
+        report["results"].append({"products": size, "phases": summarize(runs, memory_run)})
+        for phase, result in report["results"][-1]["phases"].items():
+            print(f"{size:>6} {phase:<24} {result['ms_median']:>10.1f} ms {result['mongo_commands']:>6} cmds {result['peak_kib']:>10.0f} KiB", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,1306 @@
 import streamlit as st
 import pandas as pd
+import re
 import math
+import bisect
+import difflib
+import unicodedata
+import copy
+import codecs
+import csv
+import json
+import hashlib
+import numpy as np
+import io
+import os
+import time
+import logging
+import functools
+import zipfile
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import Counter
 from fpdf import FPDF
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring, UpdateOne, ReplaceOne, DeleteOne, ReturnDocument, IndexModel, ASCENDING
+from pymongo.errors import PyMongoError, BulkWriteError, OperationFailure
 from urllib.parse import quote_plus
 from streamlit_extras.tags import tagger_component
-from bson import ObjectId
+from bson import ObjectId, encode, json_util
+from bson.errors import InvalidDocument
 
 st.set_page_config(layout="wide", page_title="Suivi de Mise en Place")
 
+profiling_logger = logging.getLogger("mazette.profiling")
+writes_logger = logging.getLogger("mazette.writes")
+snapshot_logger = logging.getLogger("mazette.snapshot")
+# One JSON line per run on stderr; MAZETTE_PROFILING_LOG sets the level, DEBUG adds
+# the sync watcher's runs and WARNING silences it
+if not profiling_logger.handlers:
+    profiling_logger.addHandler(logging.StreamHandler())
+    profiling_logger.setLevel(os.environ.get("MAZETTE_PROFILING_LOG", "INFO").upper())
+    profiling_logger.propagate = False
+
+# Profiling: every script run collects its Mongo commands and timings in a
+# thread-local, commands sent from other threads go to the background totals.
+@st.cache_resource
+def profiling_state():
+    return {'local': threading.local(), 'background': new_run_stats(), 'lock': threading.Lock()}
+
+def new_run_stats(measure_bytes=False):
+    return {'commands': Counter(), 'mongo_ms': 0.0, 'measure_bytes': measure_bytes, 'bytes_sent': 0, 'bytes_received': 0, 'failed': 0, 'timers': {}}
+
+def current_run_stats():
+    return getattr(profiling_state()['local'], 'stats', None)
+
+class CommandStats(monitoring.CommandListener):
+    def record(self, update):
+        stats = current_run_stats()
+        if stats is not None:
+            update(stats)
+        else:
+            with profiling_state()['lock']:
+                update(profiling_state()['background'])
+
+    # Sizes cost a BSON encode of every command and reply, so only runs that show them measure them
+    def started(self, event):
+        stats = current_run_stats()
+        if stats is not None and stats['measure_bytes']:
+            stats['bytes_sent'] += len(encode(event.command))
+
+    def succeeded(self, event):
+        def update(stats):
+            stats['commands'][event.command_name] += 1
+            stats['mongo_ms'] += event.duration_micros / 1000
+            if stats['measure_bytes']:
+                stats['bytes_received'] += len(encode(event.reply))
+        self.record(update)
+
+    def failed(self, event):
+        def update(stats):
+            stats['commands'][event.command_name] += 1
+            stats['mongo_ms'] += event.duration_micros / 1000
+            stats['failed'] += 1
+        self.record(update)
+
+def profiled(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats = current_run_stats()
+                if stats is not None:
+                    stats['timers'][name] = stats['timers'].get(name, 0.0) + (time.perf_counter() - start) * 1000
+        return wrapper
+    return decorator
+
+def debug_enabled():
+    return st.query_params.get("debug") == "1"
+
+@contextmanager
+def profiled_run(event='rerun', measure_bytes=False, level=logging.INFO):
+    # A fragment rendered by a full rerun is part of that rerun's stats
+    if current_run_stats() is not None:
+        yield current_run_stats()
+        return
+    local = profiling_state()['local']
+    local.stats = stats = new_run_stats(measure_bytes)
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        local.stats = None
+        stats['total_ms'] = (time.perf_counter() - start) * 1000
+        if event == 'rerun':
+            st.session_state.last_run_stats = stats
+        line = {
+            'event': event,
+            'day': st.session_state.get('session_key'),
+            'total_ms': round(stats['total_ms'], 1),
+            'mongo_commands': sum(stats['commands'].values()),
+            'mongo_ms': round(stats['mongo_ms'], 1),
+            'failed_commands': stats['failed'],
+            'commands': dict(stats['commands']),
+            'timers_ms': {name: round(ms, 1) for name, ms in stats['timers'].items()}
+        }
+        if measure_bytes:
+            line.update(bytes_sent=stats['bytes_sent'], bytes_received=stats['bytes_received'])
+        profiling_logger.log(level, json.dumps(line))
+
+def profiled_fragment(name, level=logging.INFO):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profiled_run(f'fragment:{name}', debug_enabled(), level):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def render_debug_panel():
+    stats = st.session_state.get('last_run_stats')
+    with st.expander("Débogage : dernier passage", expanded=True):
+        if stats is None:
+            st.caption("Pas encore de mesure")
+            return
+        st.write(f"Durée totale : {stats['total_ms']:.0f} ms")
+        st.write(f"Mongo : {sum(stats['commands'].values())} commandes, {stats['mongo_ms']:.0f} ms, "
+                 f"{stats['bytes_sent']} o envoyés, {stats['bytes_received']} o reçus")
+        if stats['commands']:
+            st.dataframe(pd.DataFrame(stats['commands'].most_common(), columns=['Commande', 'Nombre']), hide_index=True)
+        if stats['timers']:
+            st.dataframe(pd.DataFrame(sorted(stats['timers'].items(), key=lambda timer: -timer[1]), columns=['Étape', 'ms']), hide_index=True)
+        background = profiling_state()['background']
+        st.caption(f"En arrière-plan depuis le démarrage : {sum(background['commands'].values())} commandes, "
+                   f"{background['mongo_ms']:.0f} ms, {background['failed']} échecs")
+
 # MongoDB connection
 @st.cache_resource
 def init_connection():
-    username = quote_plus(st.secrets["mongo"]["username"])
-    password = quote_plus(st.secrets["mongo"]["password"])
-    cluster = "mazette.dgv4a.mongodb.net"
-    connection_string = f"mongodb+srv://{username}:{password}@{cluster}/?retryWrites=true&w=majority"
-    return MongoClient(connection_string)
+    # MONGO_URI points the app at another server, e.g. a local mongod for benchmarks
+    connection_string = os.environ.get("MONGO_URI")
+    if not connection_string:
+        username = quote_plus(st.secrets["mongo"]["username"])
+        password = quote_plus(st.secrets["mongo"]["password"])
+        cluster = "mazette.dgv4a.mongodb.net"
+        connection_string = f"mongodb+srv://{username}:{password}@{cluster}/?retryWrites=true&w=majority"
+    return MongoClient(connection_string, event_listeners=[CommandStats()])
 
 client = init_connection()
 db = client.mazette
 
-def init_session():
-    if 'products' not in st.session_state:
-        st.session_state.products = {item['name']: {**item, '_id': str(item['_id']), 'tasks': item.get('tasks', [])} for item in db.products.find()}
-    
-    days = ["LUNDI", "MARDI", "JEUDI", "VENDREDI"]
-    for day in days:
-        if f'{day}_checklist' not in st.session_state:
-            checklist_data = db.checklists.find_one({'session_key': day})
-            st.session_state[f'{day}_checklist'] = pd.DataFrame(checklist_data['items'] if checklist_data else [], columns=['Produit', 'Quantité'])
-        
-        if f'{day}_general_todos' not in st.session_state:
-            todos_data = list(db.general_todos.find({'session_key': day}))
-            st.session_state[f'{day}_general_todos'] = todos_data if todos_data else []
+DAYS = ["LUNDI", "MARDI", "JEUDI", "VENDREDI"]
+SYNC_SECONDS = 1
+SYNCED_COLLECTIONS = ['products', 'checklists', 'general_todos', 'completions']
+WRITE_FLUSH_SECONDS = 1
+WRITE_RETRY_MAX_SECONDS = 30
+SEARCH_LIMIT = 20
+SNAPSHOT_SECONDS = 10
+IMPORT_CHUNK_ROWS = 500
+EXPORT_BATCH_SIZE = 1000
+# Raised by files that cannot be read at all: bad encoding, broken CSV or JSON
+UNREADABLE_FILE_ERRORS = (ValueError, csv.Error)
+# Set MAZETTE_SNAPSHOT to an empty string to run without a local snapshot
+SNAPSHOT_PATH = os.environ.get("MAZETTE_SNAPSHOT", "mazette_snapshot.sqlite3")
 
-def save_current_session():
-    # Save checklist
-    db.checklists.update_one(
-        {'session_key': st.session_state.session_key},
-        {'$set': {'items': st.session_state[f'{st.session_state.session_key}_checklist'].to_dict(orient='records')}},
-        upsert=True
+# Local copy of the synced collections and of the write queue, in SQLite. A process
+# starts from it without waiting on Atlas; a background thread keeps it in step with
+# Mongo by revision, and saves write their documents into it as they are made.
+@st.cache_resource
+def local_snapshot():
+    snapshot = {
+        'lock': threading.Lock(),
+        'connection': None,
+        'complete': False,
+        'revisions': {},
+        'documents': {collection: {} for collection in SYNCED_COLLECTIONS},
+        'dirty': set()
+    }
+    if not SNAPSHOT_PATH:
+        return snapshot
+
+    connection = sqlite3.connect(SNAPSHOT_PATH, check_same_thread=False)
+    connection.executescript(
+        "CREATE TABLE IF NOT EXISTS documents (collection TEXT, key TEXT, body TEXT, PRIMARY KEY (collection, key));"
+        "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);"
+        "CREATE TABLE IF NOT EXISTS pending_writes (position INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE, entry TEXT);"
     )
-    
-    # Save products
-    for product_name, product_data in st.session_state.products.items():
-        product_data_without_id = {k: v for k, v in product_data.items() if k != '_id'}
-        
-        existing_product = db.products.find_one({'name': product_name})
-        if existing_product:
-            db.products.update_one(
-                {'_id': existing_product['_id']},
-                {'$set': product_data_without_id}
-            )
+    snapshot['connection'] = connection
+    revisions = connection.execute("SELECT value FROM meta WHERE name = 'revisions'").fetchone()
+    if revisions is not None:
+        snapshot['revisions'] = json.loads(revisions[0])
+        snapshot['complete'] = True
+        for collection, key, body in connection.execute("SELECT collection, key, body FROM documents"):
+            snapshot['documents'][collection][key] = json_util.loads(body)
+    threading.Thread(target=run_snapshot, args=(snapshot,), daemon=True, name="snapshot").start()
+    return snapshot
+
+def snapshot_key(collection, document):
+    if collection == 'products':
+        return document['name']
+    if collection == 'general_todos':
+        return str(document['_id'])
+    return document['session_key']
+
+def snapshot_put(collection, key, document):
+    # document None removes it
+    snapshot = local_snapshot()
+    if snapshot['connection'] is None:
+        return
+    with snapshot['lock']:
+        if document is None:
+            snapshot['documents'][collection].pop(key, None)
         else:
-            db.products.insert_one(product_data_without_id)
-    
-    # Save general todos
-    db.general_todos.delete_many({'session_key': st.session_state.session_key})
-    if st.session_state[f'{st.session_state.session_key}_general_todos']:
-        db.general_todos.insert_many([{**todo, 'session_key': st.session_state.session_key} for todo in st.session_state[f'{st.session_state.session_key}_general_todos']])
+            snapshot['documents'][collection][key] = document
+        snapshot['dirty'].add((collection, key))
+
+def committed_revision(counter):
+    # Counters written before committed existed only count revisions that landed
+    return counter.get('committed', counter['revision'])
+
+def read_revisions():
+    return {counter['_id']: committed_revision(counter) for counter in db.counters.find({'_id': {'$in': SYNCED_COLLECTIONS}})}
+
+def reconcile_snapshot(snapshot):
+    revisions = read_revisions()
+    changes = {}
+    for collection in SYNCED_COLLECTIONS:
+        if not snapshot['complete']:
+            changes[collection] = {snapshot_key(collection, document): document for document in db[collection].find({'deleted': {'$ne': True}})}
+        elif revisions.get(collection, 0) > snapshot['revisions'].get(collection, 0):
+            documents = db[collection].find({'revision': {'$gt': snapshot['revisions'].get(collection, 0)}})
+            changes[collection] = {snapshot_key(collection, document): None if document.get('deleted') else document for document in documents}
+    # Products are kept the way the catalog holds them
+    for product_name, product_data in changes.get('products', {}).items():
+        if product_data is not None:
+            changes['products'][product_name] = load_product(product_data)
+
+    with snapshot['lock']:
+        for collection, documents in changes.items():
+            for key, document in documents.items():
+                if document is None:
+                    snapshot['documents'][collection].pop(key, None)
+                else:
+                    snapshot['documents'][collection][key] = document
+                snapshot['dirty'].add((collection, key))
+        if not snapshot['complete'] or revisions != snapshot['revisions']:
+            snapshot['revisions'] = revisions
+            snapshot['complete'] = True
+            snapshot['dirty'].add(('meta', 'revisions'))
+
+def write_snapshot(snapshot):
+    with snapshot['lock']:
+        dirty = snapshot['dirty']
+        snapshot['dirty'] = set()
+        rows = [(collection, key, snapshot['documents'][collection].get(key)) for collection, key in dirty if collection != 'meta']
+        revisions = json.dumps(snapshot['revisions']) if ('meta', 'revisions') in dirty else None
+    # Documents are replaced, never mutated, so they are serialized outside the lock
+    bodies = []
+    for collection, key, document in rows:
+        try:
+            bodies.append((collection, key, None if document is None else json_util.dumps(document)))
+        except (TypeError, ValueError):
+            snapshot_logger.exception("Snapshot cannot serialize %s %s", collection, key)
+    try:
+        # The connection is shared with the write queue, which persists under the same lock
+        with snapshot['lock'], snapshot['connection'] as connection:
+            for collection, key, body in bodies:
+                if body is None:
+                    connection.execute("DELETE FROM documents WHERE collection = ? AND key = ?", (collection, key))
+                else:
+                    connection.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)", (collection, key, body))
+            if revisions is not None:
+                connection.execute("INSERT OR REPLACE INTO meta VALUES ('revisions', ?)", (revisions,))
+    except sqlite3.Error:
+        # Written again on the next pass
+        with snapshot['lock']:
+            snapshot['dirty'] |= dirty
+        raise
+
+def run_snapshot(snapshot):
+    while True:
+        try:
+            reconcile_snapshot(snapshot)
+        except PyMongoError:
+            pass
+        if snapshot['dirty']:
+            try:
+                write_snapshot(snapshot)
+            except sqlite3.Error:
+                snapshot_logger.exception("Snapshot write failed")
+        time.sleep(SNAPSHOT_SECONDS)
+
+def persist_writes(snapshot, entries):
+    if snapshot['connection'] is None:
+        return
+    with snapshot['lock'], snapshot['connection'] as connection:
+        for key, entry in entries:
+            connection.execute("INSERT OR REPLACE INTO pending_writes (key, entry) VALUES (?, ?)", (json_util.dumps(list(key)), json_util.dumps(entry)))
+
+def forget_writes(snapshot, keys):
+    if snapshot['connection'] is None or not keys:
+        return
+    with snapshot['lock'], snapshot['connection'] as connection:
+        connection.executemany("DELETE FROM pending_writes WHERE key = ?", [(json_util.dumps(list(key)),) for key in keys])
+
+def persisted_writes(snapshot):
+    if snapshot['connection'] is None:
+        return {}
+    with snapshot['lock']:
+        rows = snapshot['connection'].execute("SELECT key, entry FROM pending_writes ORDER BY position").fetchall()
+    return {tuple(json_util.loads(key)): json_util.loads(entry) for key, entry in rows}
+
+# Product catalog shared by every session of this process. Product dicts in it are
+# never mutated: writers publish new dicts and replace the mapping as a whole.
+@st.cache_resource
+def product_catalog():
+    return {'lock': threading.Lock(), 'revision': None, 'products': {}}
+
+def load_product(item):
+    return {**item, '_id': str(item['_id']), 'tasks': item.get('tasks', [])}
+
+def new_element_id():
+    return str(ObjectId())
+
+def assign_element_ids(product_data):
+    # Items, tasks and their subtasks need a stable id for targeted array updates
+    assigned = False
+    for key in ('items', 'tasks'):
+        for element in product_data.get(key, []):
+            for target in [element] + element.get('subtasks', []):
+                if 'id' not in target:
+                    target['id'] = new_element_id()
+                    assigned = True
+    return assigned
+
+def element_ids_missing(product_data):
+    return any('id' not in target for key in ('items', 'tasks') for element in product_data.get(key, []) for target in [element] + element.get('subtasks', []))
+
+def migrate_element_ids(products):
+    entries = []
+    for product_name, product_data in products.items():
+        if element_ids_missing(product_data):
+            # Snapshot products are shared with the snapshot, so ids go on a copy
+            product_data = products[product_name] = copy.deepcopy(product_data)
+            assign_element_ids(product_data)
+            # Only applies if nobody wrote the product since, e.g. when it came from a stale snapshot
+            entries.append((('products', product_name), {
+                'collection': 'products',
+                'op': 'update',
+                'filter': {'name': product_name, 'revision': product_data.get('revision')},
+                'document': {'$set': {'items': product_data.get('items', []), 'tasks': product_data['tasks']}},
+                'upsert': False,
+                'revision': True
+            }))
+    if entries:
+        enqueue_writes(entries)
+
+def diff_elements(path, old_elements, new_elements, depth, update):
+    # Fills update with the pulls, pushes and positional sets turning old_elements into
+    # new_elements. Returns False when the arrays cannot be matched by id or were reordered.
+    old_by_id = {element.get('id'): element for element in old_elements}
+    new_by_id = {element.get('id'): element for element in new_elements}
+    if None in old_by_id or None in new_by_id or len(old_by_id) != len(old_elements) or len(new_by_id) != len(new_elements):
+        return False
+    kept = [element['id'] for element in new_elements if element['id'] in old_by_id]
+    if kept != [element['id'] for element in old_elements if element['id'] in new_by_id]:
+        return False
+    added = [element for element in new_elements if element['id'] not in old_by_id]
+    if added and [element['id'] for element in new_elements[:len(kept)]] != kept:
+        return False
+
+    removed = [element_id for element_id in old_by_id if element_id not in new_by_id]
+    if removed:
+        update['pulls'][depth][path] = {'id': {'$in': removed}}
+    if added:
+        update['pushes'][depth][path] = {'$each': added}
+
+    for element_id in kept:
+        old_element, new_element = old_by_id[element_id], new_by_id[element_id]
+        if old_element == new_element:
+            continue
+        identifier = f"e{len(update['filters'])}"
+        update['filters'][identifier] = {f'{identifier}.id': element_id}
+        element_path = f"{path}.$[{identifier}]"
+        for key in old_element.keys() | new_element.keys():
+            if old_element.get(key) == new_element.get(key):
+                continue
+            if key == 'subtasks' and depth == 0 and diff_elements(f"{element_path}.subtasks", old_element.get(key, []), new_element.get(key, []), 1, update):
+                continue
+            if key in new_element:
+                update['sets'][f"{element_path}.{key}"] = new_element[key]
+            else:
+                update['unsets'][f"{element_path}.{key}"] = ''
+    return True
+
+def product_update_operations(old, new):
+    update = {'sets': {}, 'unsets': {}, 'filters': {}, 'pulls': [{}, {}], 'pushes': [{}, {}]}
+    for key in old.keys() | new.keys():
+        if key in ('_id', 'revision') or old.get(key) == new.get(key):
+            continue
+        if key in ('items', 'tasks') and diff_elements(key, old.get(key, []), new.get(key, []), 0, update):
+            continue
+        if key in new:
+            update['sets'][key] = new[key]
+        else:
+            update['unsets'][key] = ''
+
+    # Paths that are prefixes of each other cannot share an update, hence one stage per kind
+    stages = [
+        {'$set': update['sets'], '$unset': update['unsets']},
+        {'$pull': update['pulls'][1]},
+        {'$push': update['pushes'][1]},
+        {'$pull': update['pulls'][0]},
+        {'$push': update['pushes'][0]}
+    ]
+    operations = []
+    for stage in stages:
+        document = {operator: fields for operator, fields in stage.items() if fields}
+        if not document:
+            continue
+        paths = " ".join(path for fields in document.values() for path in fields)
+        identifiers = sorted(set(re.findall(r"\$\[(\w+)\]", paths)))
+        operations.append((document, [update['filters'][identifier] for identifier in identifiers]))
+    return operations
+
+def apply_product_operations(product_data, operations):
+    # Applies product_update_operations the way Mongo does, on a copy
+    product_data = copy.deepcopy(product_data)
+    for document, array_filters in operations:
+        filters = {key.split('.')[0]: value for array_filter in array_filters for key, value in array_filter.items()}
+        for operator, fields in document.items():
+            for path, value in fields.items():
+                *parents, last = path.split('.')
+                containers = [product_data]
+                for part in parents:
+                    identifier = re.fullmatch(r"\$\[(\w+)\]", part)
+                    if identifier:
+                        containers = [element for container in containers for element in container if element.get('id') == filters[identifier.group(1)]]
+                    else:
+                        containers = [container[part] for container in containers if part in container]
+                for container in containers:
+                    if operator == '$set':
+                        container[last] = copy.deepcopy(value)
+                    elif operator == '$unset':
+                        container.pop(last, None)
+                    elif operator == '$pull':
+                        container[last] = [element for element in container.get(last, []) if element.get('id') not in value['id']['$in']]
+                    elif operator == '$push':
+                        container[last] = container.get(last, []) + copy.deepcopy(value['$each'])
+    return product_data
+
+def next_revision(counter_name):
+    counter = db.counters.find_one_and_update(
+        {'_id': counter_name},
+        {'$inc': {'revision': 1}, '$setOnInsert': {'committed': 0}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter['revision']
+
+def commit_revision(collection, revision):
+    # Readers only go up to the committed revision, so it moves once the documents are
+    # written. If another writer committed past this revision while it was in flight,
+    # readers may have skipped it: its documents move to a new revision instead.
+    while True:
+        counter = db.counters.find_one_and_update({'_id': collection}, {'$max': {'committed': revision}})
+        if counter.get('committed', 0) < revision:
+            return
+        restamped = next_revision(collection)
+        db[collection].update_many({'revision': revision}, {'$set': {'revision': restamped}})
+        revision = restamped
+
+# Indexes behind the app's lookups: by name and session_key on every rerun and
+# flush, by revision for the incremental syncs. Unique ones need duplicates gone first.
+INDEXES = {
+    'products': [IndexModel([('name', ASCENDING)], unique=True), IndexModel([('revision', ASCENDING)])],
+    'checklists': [IndexModel([('session_key', ASCENDING)], unique=True), IndexModel([('revision', ASCENDING)])],
+    'general_todos': [IndexModel([('session_key', ASCENDING)]), IndexModel([('revision', ASCENDING)])],
+    'completions': [IndexModel([('session_key', ASCENDING)], unique=True), IndexModel([('revision', ASCENDING)])]
+}
+UNIQUE_FIELDS = {'products': 'name', 'checklists': 'session_key', 'completions': 'session_key'}
+
+@st.cache_resource
+def schema_bootstrap():
+    # Runs once per process in the background, the app works without the indexes meanwhile
+    status = {'done': False, 'removed': {}, 'indexes': [], 'error': None}
+    threading.Thread(target=run_schema_bootstrap, args=(status,), daemon=True, name="schema-bootstrap").start()
+    return status
+
+def run_schema_bootstrap(status):
+    while True:
+        try:
+            bootstrap_schema(status)
+            return
+        except PyMongoError as error:
+            status['error'] = str(error)
+            time.sleep(WRITE_RETRY_MAX_SECONDS)
+
+def deduplicate(collection, field):
+    # The live document with the latest revision is kept, the others are deleted. Without
+    # revisions that is the oldest one, which the former find_one/update_one calls used.
+    groups = db[collection].aggregate([
+        {'$sort': {'revision': -1, '_id': 1}},
+        {'$group': {'_id': f'${field}', 'documents': {'$push': {'_id': '$_id', 'deleted': {'$ifNull': ['$deleted', False]}}}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ])
+    keepers = []
+    duplicates = []
+    for group in groups:
+        documents = group['documents']
+        keeper = next((document for document in documents if not document.get('deleted')), documents[0])
+        keepers.append(keeper['_id'])
+        duplicates += [document['_id'] for document in documents if document is not keeper]
+    if duplicates:
+        db[collection].delete_many({'_id': {'$in': duplicates}})
+        # Sessions may be showing a deleted duplicate, a new revision makes them fetch the keeper
+        revision = next_revision(collection)
+        db[collection].update_many({'_id': {'$in': keepers}}, {'$set': {'revision': revision}})
+        commit_revision(collection, revision)
+    return len(duplicates)
+
+def bootstrap_schema(status):
+    removed = {collection: deduplicate(collection, field) for collection, field in UNIQUE_FIELDS.items()}
+    indexes = []
+    for collection, models in INDEXES.items():
+        try:
+            db[collection].create_indexes(models)
+            error = None
+        except OperationFailure as failure:
+            # E.g. an existing index on the same keys with other options, or a duplicate written meanwhile
+            error = failure.details.get('errmsg') if failure.details else str(failure)
+        existing = db[collection].index_information().values()
+        for model in models:
+            keys = list(model.document['key'].items())
+            unique = model.document.get('unique', False)
+            present = any(list(info['key']) == keys and info.get('unique', False) == unique for info in existing)
+            indexes.append((collection, ", ".join(field for field, _ in keys), unique, present, error))
+    status.update(done=True, removed=removed, indexes=indexes, error=None)
+
+def hot_queries():
+    # The lookups every rerun, sync and flush rely on, with values taken from this process
+    revisions = current_revisions()
+    product = next(iter(product_catalog()['products']), "")
+    day = DAYS[0]
+    return [
+        ("Produit par nom", 'products', {'name': product}),
+        ("Produits modifiés", 'products', {'revision': {'$gt': revisions.get('products', 0)}}),
+        ("Commandes du jour", 'checklists', {'session_key': day}),
+        ("Tâches du jour", 'general_todos', {'session_key': day, 'deleted': {'$ne': True}}),
+        ("Coches du jour", 'completions', {'session_key': day}),
+        ("Commandes modifiées", 'checklists', {'revision': {'$gt': revisions.get('checklists', 0)}}),
+        ("Tâches modifiées", 'general_todos', {'revision': {'$gt': revisions.get('general_todos', 0)}}),
+        ("Coches modifiées", 'completions', {'revision': {'$gt': revisions.get('completions', 0)}})
+    ]
+
+def plan_stages(plan):
+    # Newer servers nest the classic plan under queryPlan
+    plan = plan.get('queryPlan', plan)
+    stages = []
+    while plan:
+        stages.append(plan['stage'] + (f" {plan['indexName']}" if 'indexName' in plan else ""))
+        plan = plan.get('inputStage') or next(iter(plan.get('inputStages', [])), None)
+    return " > ".join(stages)
+
+def explain_hot_queries():
+    rows = []
+    for label, collection, query in hot_queries():
+        try:
+            explained = db.command({'explain': {'find': collection, 'filter': query}, 'verbosity': 'executionStats'})
+        except PyMongoError as error:
+            rows.append((label, f"erreur : {error}", None, None, None))
+            continue
+        stats = explained.get('executionStats', {})
+        rows.append((label, plan_stages(explained['queryPlanner']['winningPlan']), stats.get('totalDocsExamined'), stats.get('nReturned'), stats.get('executionTimeMillis')))
+    return pd.DataFrame(rows, columns=['Requête', 'Plan', 'Documents lus', 'Renvoyés', 'ms'])
+
+def render_schema_panel():
+    status = schema_bootstrap()
+    with st.expander("Débogage : index et plans"):
+        if not status['done']:
+            st.caption(f"Création des index en attente{' : ' + status['error'] if status['error'] else ''}")
+        else:
+            removed = {collection: count for collection, count in status['removed'].items() if count}
+            if removed:
+                st.caption("Doublons supprimés : " + ", ".join(f"{collection} {count}" for collection, count in removed.items()))
+            st.dataframe(pd.DataFrame(status['indexes'], columns=['Collection', 'Clés', 'Unique', 'Présent', 'Erreur']), hide_index=True)
+        if st.button("Expliquer les requêtes"):
+            st.dataframe(explain_hot_queries(), hide_index=True)
+
+# Every flush bumps a per-collection counter in db.counters, stamps documents with it
+# and commits it once they are written, so a session only fetches documents newer
+# than the committed revision it last saw.
+@st.cache_resource
+def revision_feed():
+    # Until the first poll answers, sessions work from the revisions of the snapshot
+    snapshot = local_snapshot()
+    feed = {'lock': threading.Lock(), 'revisions': dict(snapshot['revisions']), 'ready': snapshot['complete'], 'stream': False}
+    threading.Thread(target=watch_revisions, args=(feed,), daemon=True, name="revision-feed").start()
+    return feed
+
+def watch_revisions(feed):
+    # A change stream on the counters replaces polling when the server supports one
+    while True:
+        try:
+            with db.counters.watch(full_document='updateLookup') as stream:
+                revisions = read_revisions()
+                with feed['lock']:
+                    feed['revisions'] = revisions
+                    feed['ready'] = feed['stream'] = True
+                for change in stream:
+                    counter = change.get('fullDocument')
+                    if counter and counter['_id'] in SYNCED_COLLECTIONS:
+                        with feed['lock']:
+                            feed['revisions'][counter['_id']] = committed_revision(counter)
+        except PyMongoError:
+            pass
+        feed['stream'] = False
+        # Polled from here rather than from the scripts, so a slow Atlas never holds up a rerun
+        retry_at = time.monotonic() + WRITE_RETRY_MAX_SECONDS
+        while time.monotonic() < retry_at:
+            try:
+                revisions = read_revisions()
+                with feed['lock']:
+                    feed['revisions'] = revisions
+                    feed['ready'] = True
+            except PyMongoError:
+                pass
+            time.sleep(SYNC_SECONDS)
+
+def current_revisions():
+    feed = revision_feed()
+    with feed['lock']:
+        if not feed['ready']:
+            # Without a snapshot to start from, the first session waits for the server
+            feed['revisions'] = read_revisions()
+            feed['ready'] = True
+        return dict(feed['revisions'])
+
+def refresh_catalog():
+    catalog = product_catalog()
+    revision = current_revisions().get('products', 0)
+    with catalog['lock']:
+        if catalog['revision'] is None:
+            snapshot = local_snapshot()
+            if snapshot['complete']:
+                # Products written since the snapshot are fetched just below
+                with snapshot['lock']:
+                    products = dict(snapshot['documents']['products'])
+                    catalog['revision'] = snapshot['revisions'].get('products', 0)
+            else:
+                products = {item['name']: load_product(item) for item in db.products.find({'deleted': {'$ne': True}})}
+                catalog['revision'] = revision
+            migrate_element_ids(products)
+            catalog['products'] = products
+            index_products(products, rebuild=True)
+        if revision > catalog['revision']:
+            # Only products written since our last look are fetched
+            products = dict(catalog['products'])
+            changes = {}
+            try:
+                for item in db.products.find({'revision': {'$gt': catalog['revision']}}):
+                    changes[item['name']] = None if item.get('deleted') else load_product(item)
+            except PyMongoError:
+                # Offline: the catalog stays as it is until the next run gets through
+                return catalog
+            loaded = {name: product for name, product in changes.items() if product is not None}
+            migrate_element_ids(loaded)
+            changes.update(loaded)
+            for product_name, product_data in changes.items():
+                if product_data is None:
+                    products.pop(product_name, None)
+                else:
+                    products[product_name] = product_data
+            catalog['products'] = products
+            index_products(changes)
+
+        catalog['revision'] = max(revision, catalog['revision'])
+    return catalog
+
+def publish_products(changes):
+    # The revision is left alone: it is only assigned when the write queue flushes
+    catalog = product_catalog()
+    with catalog['lock']:
+        products = dict(catalog['products'])
+        for product_name, product_data in changes.items():
+            if product_data is None:
+                products.pop(product_name, None)
+            else:
+                products[product_name] = product_data
+        catalog['products'] = products
+    index_products(changes)
+    for product_name, product_data in changes.items():
+        snapshot_put('products', product_name, product_data)
+
+# Search index over the catalog, kept up to date product by product as the catalog
+# changes. Tokens cover product, item, task and subtask names, trigrams the product
+# name only, for fuzzy matching.
+@st.cache_resource
+def product_index():
+    return {'lock': threading.Lock(), 'entries': {}, 'tokens': {}, 'sorted_tokens': [], 'trigrams': {}}
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', str(text))
+    return ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def index_entry(product_name, product_data):
+    name = normalize(product_name)
+    contents = []
+    for key in ('items', 'tasks'):
+        for element in product_data.get(key, []):
+            contents.append(element['name'])
+            contents += [subtask['name'] for subtask in element.get('subtasks', [])]
+    name_tokens = set(re.findall(r"\w+", name))
+    content_tokens = set(re.findall(r"\w+", normalize(" ".join(contents))))
+    return {'name': name, 'name_tokens': name_tokens, 'tokens': name_tokens | content_tokens, 'trigrams': trigrams(name)}
+
+def index_products(changes, rebuild=False):
+    index = product_index()
+    with index['lock']:
+        if rebuild:
+            index.update(entries={}, tokens={}, sorted_tokens=[], trigrams={})
+        for product_name, product_data in changes.items():
+            entry = index['entries'].pop(product_name, None)
+            if entry is not None:
+                for token in entry['tokens']:
+                    index['tokens'][token].discard(product_name)
+                    if not index['tokens'][token]:
+                        del index['tokens'][token]
+                        del index['sorted_tokens'][bisect.bisect_left(index['sorted_tokens'], token)]
+                for gram in entry['trigrams']:
+                    index['trigrams'][gram].discard(product_name)
+            if product_data is None:
+                continue
+            entry = index['entries'][product_name] = index_entry(product_name, product_data)
+            for token in entry['tokens']:
+                if token not in index['tokens']:
+                    index['tokens'][token] = set()
+                    bisect.insort(index['sorted_tokens'], token)
+                index['tokens'][token].add(product_name)
+            for gram in entry['trigrams']:
+                index['trigrams'].setdefault(gram, set()).add(product_name)
+
+def search_products(query, limit=SEARCH_LIMIT):
+    index = product_index()
+    query = normalize(query).strip()
+    terms = re.findall(r"\w+", query)
+    with index['lock']:
+        if not terms:
+            return sorted(index['entries'])[:limit]
+
+        # Every term has to prefix a token of the product
+        matches = None
+        for term in terms:
+            found = set()
+            for token in index['sorted_tokens'][bisect.bisect_left(index['sorted_tokens'], term):]:
+                if not token.startswith(term):
+                    break
+                found |= index['tokens'][token]
+            matches = found if matches is None else matches & found
+
+        if matches:
+            def rank(product_name):
+                entry = index['entries'][product_name]
+                if entry['name'].startswith(query):
+                    return (0, product_name)
+                if all(any(token.startswith(term) for token in entry['name_tokens']) for term in terms):
+                    return (1, product_name)
+                return (2, product_name)
+            return sorted(matches, key=rank)[:limit]
+
+        # Nothing matched as a prefix, fall back to names sharing the most trigrams
+        shared = Counter(product_name for gram in trigrams(query) for product_name in index['trigrams'].get(gram, ()))
+        scored = []
+        for product_name, _ in shared.most_common(limit * 5):
+            score = difflib.SequenceMatcher(None, query, index['entries'][product_name]['name']).ratio()
+            if score >= 0.5:
+                scored.append((-score, product_name))
+        return [product_name for _, product_name in sorted(scored)[:limit]]
+
+def product_picker(label, key, leading_options=(), trailing_options=()):
+    # Only the best matches of the search box are sent to the browser
+    query = st.text_input("Rechercher un produit", key=f"{key}_search", placeholder="Nom, élément ou tâche")
+    products = st.session_state.products
+    matches = [product_name for product_name in search_products(query) if product_name in products]
+    if not query:
+        # Products not published to the catalog yet are only in this session's view
+        matches += sorted(product_name for product_name in products if product_name not in product_catalog()['products'])[:SEARCH_LIMIT]
+    selected = st.session_state.get(key)
+    if selected in products and selected not in matches:
+        matches.insert(0, selected)
+    return st.selectbox(label, list(leading_options) + matches + list(trailing_options), key=key)
+
+def sync_products():
+    # The session view shares the catalog's product dicts; only products edited in
+    # this session (see edit_product) are copies, and they survive a catalog refresh.
+    catalog = refresh_catalog()
+    products = catalog['products']
+    st.session_state.seen_revisions['products'] = catalog['revision']
+    if 'products' not in st.session_state:
+        st.session_state.products = dict(products)
+        st.session_state.products_base = dict(products)
+        st.session_state.product_origins = {}
+        st.session_state.products_source = products
+        return
+    if products is st.session_state.products_source:
+        return
+
+    view = st.session_state.products
+    base = st.session_state.products_base
+    origins = st.session_state.product_origins
+    merged = dict(products)
+    for product_name in view.keys() | base.keys():
+        if product_name in origins and view.get(product_name) == origins[product_name]:
+            # Opened in the editor but left unchanged: the new catalog version replaces it
+            del origins[product_name]
+            continue
+        if view.get(product_name) is not base.get(product_name):
+            if product_name in view:
+                merged[product_name] = view[product_name]
+            else:
+                merged.pop(product_name, None)
+
+    st.session_state.products = merged
+    st.session_state.products_base = dict(products)
+    st.session_state.products_source = products
+
+def edit_product(product_name):
+    product = st.session_state.products[product_name]
+    if product is st.session_state.products_base.get(product_name):
+        # The version the edit started from is kept so saves only send this session's changes
+        st.session_state.product_origins.setdefault(product_name, product)
+        product = copy.deepcopy(product)
+        st.session_state.products[product_name] = product
+    return product
+
+# Only the day on screen is read before the first paint, the other days are read by
+# a small shared pool and picked up from session_state when the user switches to them.
+@st.cache_resource
+def day_loader():
+    return ThreadPoolExecutor(max_workers=len(DAYS) - 1, thread_name_prefix="day-prefetch")
+
+def load_day(day):
+    # Also runs on the prefetch pool, so it must not touch session_state
+    snapshot = local_snapshot()
+    if snapshot['complete']:
+        # Whatever changed since the snapshot is merged by sync_day_documents
+        with snapshot['lock']:
+            revisions = dict(snapshot['revisions'])
+            checklist_data = copy.deepcopy(snapshot['documents']['checklists'].get(day))
+            todos_data = copy.deepcopy([todo for todo in snapshot['documents']['general_todos'].values() if todo['session_key'] == day])
+            completions = snapshot['documents']['completions'].get(day)
+    else:
+        revisions = current_revisions()
+        checklist_data = db.checklists.find_one({'session_key': day})
+        todos_data = list(db.general_todos.find({'session_key': day, 'deleted': {'$ne': True}}))
+        completions = db.completions.find_one({'session_key': day})
+    return {
+        'revisions': revisions,
+        'items': checklist_data['items'] if checklist_data else [],
+        'todos': todos_data,
+        'done': set(completions.get('done', {})) if completions else set()
+    }
+
+def ensure_day(day):
+    if f'{day}_checklist' in st.session_state:
+        return
+    data = None
+    future = st.session_state.day_prefetch.pop(day, None)
+    if future is not None:
+        try:
+            data = future.result()
+        except PyMongoError:
+            pass
+    if data is None:
+        data = load_day(day)
+    # Data older than what this session has merged so far is brought up to date by
+    # the next sync_day_documents, which fetches everything past the oldest revision
+    seen = st.session_state.seen_revisions
+    for collection in ('checklists', 'general_todos', 'completions'):
+        seen[collection] = min(seen.get(collection, 0), data['revisions'].get(collection, 0))
+    # Ticks still waiting in the write queue, possibly from before a restart
+    for line_id, pending in pending_ticks(day).items():
+        if pending:
+            data['done'].add(line_id)
+        else:
+            data['done'].discard(line_id)
+
+    st.session_state[f'{day}_checklist'] = pd.DataFrame(data['items'], columns=['Produit', 'Quantité'])
+    st.session_state[f'saved_{day}_checklist'] = st.session_state[f'{day}_checklist'].copy()
+    st.session_state[f'{day}_general_todos'] = data['todos']
+    st.session_state[f'saved_{day}_general_todos'] = copy.deepcopy(data['todos'])
+    st.session_state[f'{day}_completions'] = data['done']
+
+@profiled("init_session")
+def init_session():
+    if 'seen_revisions' not in st.session_state:
+        st.session_state.seen_revisions = current_revisions()
+    if 'day_prefetch' not in st.session_state:
+        st.session_state.day_prefetch = {}
+    sync_products()
+
+    ensure_day(st.session_state.session_key)
+    for day in DAYS:
+        if f'{day}_checklist' not in st.session_state and day not in st.session_state.day_prefetch:
+            st.session_state.day_prefetch[day] = day_loader().submit(load_day, day)
+    # Finished prefetches are installed right away so later remote changes get merged into them
+    for day, future in list(st.session_state.day_prefetch.items()):
+        if future.done():
+            ensure_day(day)
+
+    sync_day_documents()
+    # Checkbox states changed by other tablets are applied before the widgets exist
+    for key, done in st.session_state.pop('remote_ticks', {}).items():
+        st.session_state[key] = done
+
+def sync_day_documents():
+    # Documents other sessions wrote since this one last looked are merged in, unless
+    # this session has unsaved changes to the same document. Returns the days touched.
+    revisions = current_revisions()
+    seen = st.session_state.seen_revisions
+    touched = set()
+
+    try:
+        if revisions.get('checklists', 0) > seen.get('checklists', 0):
+            for document in db.checklists.find({'revision': {'$gt': seen.get('checklists', 0)}}):
+                day = document['session_key']
+                if f'{day}_checklist' not in st.session_state:
+                    continue
+                checklist = st.session_state[f'{day}_checklist']
+                remote = pd.DataFrame(document['items'], columns=['Produit', 'Quantité'])
+                if checklist.equals(st.session_state[f'saved_{day}_checklist']) and not remote.equals(checklist):
+                    st.session_state[f'{day}_checklist'] = remote
+                    st.session_state[f'saved_{day}_checklist'] = remote.copy()
+                    touched.add(day)
+
+        if revisions.get('general_todos', 0) > seen.get('general_todos', 0):
+            for document in db.general_todos.find({'revision': {'$gt': seen.get('general_todos', 0)}}):
+                day = document['session_key']
+                if f'{day}_general_todos' not in st.session_state:
+                    continue
+                todos = st.session_state[f'{day}_general_todos']
+                saved = st.session_state[f'saved_{day}_general_todos']
+                local = next((todo for todo in todos if todo['_id'] == document['_id']), None)
+                if local != next((todo for todo in saved if todo['_id'] == document['_id']), None) or local == document:
+                    continue
+                todos[:] = [todo for todo in todos if todo['_id'] != document['_id']]
+                saved[:] = [todo for todo in saved if todo['_id'] != document['_id']]
+                if not document.get('deleted'):
+                    todos.append(document)
+                    saved.append(copy.deepcopy(document))
+                touched.add(day)
+
+        if revisions.get('completions', 0) > seen.get('completions', 0):
+            for document in db.completions.find({'revision': {'$gt': seen.get('completions', 0)}}):
+                day = document['session_key']
+                if f'{day}_completions' not in st.session_state:
+                    continue
+                done = set(document.get('done', {}))
+                # Ticks still waiting in the write queue win over what is stored
+                for line_id, pending in pending_ticks(day).items():
+                    if pending:
+                        done.add(line_id)
+                    else:
+                        done.discard(line_id)
+                previous = st.session_state[f'{day}_completions']
+                if done == previous:
+                    continue
+                remote_ticks = st.session_state.setdefault('remote_ticks', {})
+                for line_id in done ^ previous:
+                    remote_ticks[checkbox_key(day, line_id)] = line_id in done
+                st.session_state[f'{day}_completions'] = done
+                touched.add(day)
+    except PyMongoError:
+        # Offline: keep working from what this session has, the next run tries again
+        return touched
+
+    for collection in ('checklists', 'general_todos', 'completions'):
+        seen[collection] = max(revisions.get(collection, 0), seen.get(collection, 0))
+    return touched
+
+@st.fragment(run_every=SYNC_SECONDS)
+@profiled_fragment('watch_remote_changes', logging.DEBUG)
+def watch_remote_changes():
+    touched = sync_day_documents()
+    products_changed = refresh_catalog()['revision'] > st.session_state.seen_revisions.get('products', 0)
+    if st.session_state.session_key in touched or products_changed:
+        st.rerun()
+
+# Write-behind queue shared by the process. Saves only enqueue writes; a background
+# thread sends them, so the UI never waits on Atlas. Entries with the same key are
+# coalesced, the latest one replacing the earlier one at the end of the queue.
+@st.cache_resource
+def write_queue():
+    # Writes left over from a previous process are sent first
+    snapshot = local_snapshot()
+    queue = {'lock': threading.Lock(), 'wake': threading.Event(), 'pending': persisted_writes(snapshot), 'snapshot': snapshot, 'failures': 0, 'retry_at': 0.0, 'last_error': None, 'dropped': 0, 'uncommitted': {}}
+    threading.Thread(target=run_write_queue, args=(queue,), daemon=True, name="write-behind").start()
+    return queue
+
+def enqueue_writes(entries):
+    queue = write_queue()
+    with queue['lock']:
+        for key, entry in entries:
+            queue['pending'].pop(key, None)
+            queue['pending'][key] = entry
+        persist_writes(queue['snapshot'], entries)
+
+def flush_writes():
+    write_queue()['wake'].set()
+
+def queued_operation(entry, revision):
+    document = entry['document']
+    if entry.get('revision'):
+        if entry['op'] == 'update':
+            document = {**document, '$set': {**document.get('$set', {}), 'revision': revision}}
+        else:
+            document = {**document, 'revision': revision}
+    if entry['op'] == 'delete':
+        return DeleteOne(entry['filter'])
+    if entry['op'] == 'replace':
+        return ReplaceOne(entry['filter'], document, upsert=entry['upsert'])
+    return UpdateOne(entry['filter'], document, upsert=entry['upsert'], array_filters=entry.get('array_filters'))
+
+def encodable(entry):
+    try:
+        encode({'filter': entry['filter'], 'document': entry['document']})
+        return True
+    except (InvalidDocument, OverflowError):
+        return False
+
+def drop_writes(queue, rejected, message):
+    with queue['lock']:
+        dropped = [key for key, entry in rejected if queue['pending'].get(key) is entry]
+        for key in dropped:
+            del queue['pending'][key]
+        forget_writes(queue['snapshot'], dropped)
+    queue['dropped'] += len(rejected)
+    queue['last_error'] = message
+    writes_logger.error("%d write(s) dropped: %s", len(rejected), message)
+
+def backoff_writes(queue, message):
+    queue['failures'] += 1
+    queue['retry_at'] = time.monotonic() + min(WRITE_FLUSH_SECONDS * 2 ** queue['failures'], WRITE_RETRY_MAX_SECONDS)
+    queue['last_error'] = message
+
+def flush_write_queue(queue):
+    with queue['lock']:
+        batch = list(queue['pending'].items())
+    # A document BSON cannot encode would fail the whole batch on every retry
+    rejected = [(key, entry) for key, entry in batch if not encodable(entry)]
+    if rejected:
+        drop_writes(queue, rejected, "document impossible à encoder pour la base")
+    rejected_keys = {key for key, _ in rejected}
+    collections = {}
+    for key, entry in batch:
+        if key not in rejected_keys:
+            collections.setdefault(entry['collection'], []).append((key, entry))
+
+    failed = False
+    for collection, entries in collections.items():
+        done = len(entries)
+        try:
+            revision = next_revision(collection) if any(entry.get('revision') for _, entry in entries) else None
+            db[collection].bulk_write([queued_operation(entry, revision) for _, entry in entries], ordered=True)
+        except BulkWriteError as error:
+            # Writes before the rejected one went through, the rejected one will never succeed
+            index = error.details['writeErrors'][0]['index']
+            done = index
+            drop_writes(queue, entries[index:index + 1], error.details['writeErrors'][0]['errmsg'])
+        except PyMongoError as error:
+            failed = True
+            backoff_writes(queue, str(error))
+            continue
+
+        if revision is not None and done:
+            queue['uncommitted'].setdefault(collection, []).append(revision)
+        with queue['lock']:
+            sent = [key for key, entry in entries[:done] if queue['pending'].get(key) is entry]
+            for key in sent:
+                del queue['pending'][key]
+            forget_writes(queue['snapshot'], sent)
+    if commit_revisions(queue) and not failed:
+        queue['failures'] = 0
+
+def commit_revisions(queue):
+    # Written but not yet committed revisions stay here until the commit goes through,
+    # the writes themselves are never sent twice
+    for collection, revisions in queue['uncommitted'].items():
+        try:
+            while revisions:
+                commit_revision(collection, revisions[0])
+                revisions.pop(0)
+        except PyMongoError as error:
+            backoff_writes(queue, str(error))
+            return False
+    return True
+
+def run_write_queue(queue):
+    while True:
+        queue['wake'].wait(WRITE_FLUSH_SECONDS)
+        queue['wake'].clear()
+        if (queue['pending'] or any(queue['uncommitted'].values())) and time.monotonic() >= queue['retry_at']:
+            try:
+                flush_write_queue(queue)
+            except Exception as error:
+                # Keep the thread alive, the queue is retried after the backoff
+                writes_logger.exception("Write queue flush failed")
+                backoff_writes(queue, repr(error))
+
+def render_write_status():
+    queue = write_queue()
+    pending = len(queue['pending'])
+    if queue['failures']:
+        retry_in = max(0, queue['retry_at'] - time.monotonic())
+        st.warning(f"Connexion perdue : {pending} modification(s) en attente, nouvel essai dans {retry_in:.0f} s")
+        st.caption(f"Dernière erreur : {queue['last_error']}")
+    elif pending:
+        st.caption(f"⏳ {pending} modification(s) en cours d'enregistrement")
+    else:
+        st.caption("✅ Tout est enregistré")
+    if queue['dropped']:
+        st.error(f"{queue['dropped']} modification(s) refusée(s) par la base et abandonnée(s) : {queue['last_error']}")
+
+def save_checklist(day):
+    checklist = st.session_state[f'{day}_checklist']
+    saved = st.session_state.get(f'saved_{day}_checklist')
+    if saved is not None and checklist.equals(saved):
+        return
+
+    # Rows appended after the saved ones are pushed, anything else rewrites the list
+    if saved is not None and 0 < len(saved) < len(checklist) and checklist.iloc[:len(saved)].equals(saved):
+        new_rows = checklist.iloc[len(saved):].to_dict(orient='records')
+        key = ('checklists', day, str(ObjectId()))
+        entry = {'collection': 'checklists', 'op': 'update', 'filter': {'session_key': day}, 'document': {'$push': {'items': {'$each': new_rows}}}, 'upsert': True, 'revision': True}
+    else:
+        key = ('checklists', day)
+        entry = {'collection': 'checklists', 'op': 'update', 'filter': {'session_key': day}, 'document': {'$set': {'items': checklist.to_dict(orient='records')}}, 'upsert': True, 'revision': True}
+
+    enqueue_writes([(key, entry)])
+    snapshot_put('checklists', day, {'session_key': day, 'items': checklist.to_dict(orient='records')})
+    st.session_state[f'saved_{day}_checklist'] = checklist.copy()
+
+def save_products(product_names=None):
+    products = st.session_state.products
+    base = st.session_state.products_base
+    current = product_catalog()['products']
+    changed = []
+    removed = []
+
+    origins = st.session_state.product_origins
+
+    for product_name in (products.keys() | base.keys() if product_names is None else product_names):
+        product_data = products.get(product_name)
+        if product_data is base.get(product_name):
+            continue
+        if product_data is None:
+            origins.pop(product_name, None)
+            if product_name in current:
+                removed.append(product_name)
+            else:
+                del base[product_name]
+        elif product_data == current.get(product_name):
+            origins.pop(product_name, None)
+            products[product_name] = base[product_name] = current[product_name]
+        else:
+            changed.append(product_name)
+
+    if not changed and not removed:
+        return
+
+    entries = []
+    changes = {}
+    for product_name in changed:
+        product_data = products[product_name]
+        product_data['name'] = product_name
+        origin = origins.pop(product_name, None)
+        if origin is not None and product_name in current:
+            # Existing products get targeted array updates built from this session's edits,
+            # and the catalog gets them on top of its own version, which may be newer
+            operations = product_update_operations(origin, product_data)
+            if not operations:
+                products[product_name] = base[product_name] = current[product_name]
+                continue
+            product_data = products[product_name] = apply_product_operations(current[product_name], operations)
+            for document, array_filters in operations:
+                entries.append((('products', product_name, new_element_id()), {
+                    'collection': 'products',
+                    'op': 'update',
+                    'filter': {'name': product_name},
+                    'document': document,
+                    'array_filters': array_filters or None,
+                    'upsert': False,
+                    'revision': True
+                }))
+        else:
+            product_data_without_id = {k: v for k, v in product_data.items() if k not in ('_id', 'revision')}
+            entries.append((('products', product_name), {
+                'collection': 'products',
+                'op': 'update',
+                'filter': {'name': product_name},
+                'document': {'$set': product_data_without_id, '$unset': {'deleted': ''}},
+                'upsert': True,
+                'revision': True
+            }))
+        changes[product_name] = base[product_name] = product_data
+    # Deleted products are kept as tombstones so other processes notice the removal
+    for product_name in removed:
+        entries.append((('products', product_name), {
+            'collection': 'products',
+            'op': 'update',
+            'filter': {'name': product_name},
+            'document': {'$set': {'deleted': True}},
+            'upsert': False,
+            'revision': True
+        }))
+        changes[product_name] = None
+        base.pop(product_name, None)
+
+    enqueue_writes(entries)
+    publish_products(changes)
+
+def save_general_todos(day):
+    todos = st.session_state[f'{day}_general_todos']
+    saved = {todo['_id']: todo for todo in st.session_state.get(f'saved_{day}_general_todos', [])}
+    entries = []
+
+    for todo in todos:
+        todo.setdefault('_id', ObjectId())
+        if saved.pop(todo['_id'], None) != todo:
+            entry = {'collection': 'general_todos', 'op': 'replace', 'filter': {'_id': todo['_id']}, 'document': {**todo, 'session_key': day}, 'upsert': True, 'revision': True}
+            entries.append((('general_todos', todo['_id']), entry))
+    # Removed todos are kept as tombstones so other sessions notice the removal
+    for todo_id in saved:
+        entry = {'collection': 'general_todos', 'op': 'update', 'filter': {'_id': todo_id}, 'document': {'$set': {'deleted': True}}, 'upsert': False, 'revision': True}
+        entries.append((('general_todos', todo_id), entry))
+
+    if not entries:
+        return
+
+    enqueue_writes(entries)
+    for (_, todo_id), entry in entries:
+        snapshot_put('general_todos', str(todo_id), entry['document'] if entry['op'] == 'replace' else None)
+    st.session_state[f'saved_{day}_general_todos'] = copy.deepcopy(todos)
+
+def mark_done(day, line_id, done):
+    # One atomic field update per tick, product documents are never touched
+    completions = st.session_state[f'{day}_completions']
+    if done:
+        completions.add(line_id)
+        update = {'$set': {f'done.{line_id}': True}}
+    else:
+        completions.discard(line_id)
+        update = {'$unset': {f'done.{line_id}': ''}}
+    entry = {'collection': 'completions', 'op': 'update', 'filter': {'session_key': day}, 'document': update, 'upsert': True, 'revision': True}
+    enqueue_writes([(('completions', day, line_id), entry)])
+    snapshot_put('completions', day, {'session_key': day, 'done': dict.fromkeys(completions, True)})
+
+def pending_ticks(day):
+    queue = write_queue()
+    with queue['lock']:
+        # Only tick entries, keyed (completions, day, line); other writes may share the prefix
+        entries = [(key, entry) for key, entry in queue['pending'].items() if len(key) == 3 and key[:2] == ('completions', day)]
+    return {key[2]: '$set' in entry['document'] for key, entry in entries}
+
+def checkbox_key(day, line_id):
+    return f"done_{day}_{line_id}"
+
+def todo_task_id(todo):
+    return task_id('todo', todo['_id'])
+
+@profiled("save_current_session")
+def save_current_session():
+    # Only documents that changed since the last save are written
+    save_checklist(st.session_state.session_key)
+    save_products()
+    save_general_todos(st.session_state.session_key)
 
 def set_theme(day):
     themes = {
@@ -68,15 +1309,54 @@ def set_theme(day):
     color = themes.get(day, "#FFFFFF")
     st.markdown(f"<style>.stApp {{background-color: {color};}}</style>", unsafe_allow_html=True)
 
-def calculate_needed_items(product, quantity):
-    items = st.session_state.products[product]["items"]
-    return [{
-        "name": item['name'],
-        "count": math.ceil(quantity / item["capacity"]),
-        "subtasks": item["subtasks"],
-        "done": item.get("done", False),
-        "tags": item.get("tags", [])
-    } for item in items]
+PLAN_COLUMNS = ['Produit', 'kind', 'position', 'subposition', 'name', 'capacity', 'task_id']
+
+def plan_structure(product_data):
+    # The parts of a product that shape its checklist lines, without any done flags
+    return {
+        'items': [[item.get('id'), item['name'], item['capacity'], [[subtask.get('id'), subtask['name']] for subtask in item.get('subtasks', [])]] for item in product_data.get('items', [])],
+        'tasks': [[task.get('id'), task['name'], [[subtask.get('id'), subtask['name']] for subtask in task.get('subtasks', [])]] for task in product_data.get('tasks', [])]
+    }
+
+def task_id(*parts):
+    # Stable id of a checklist line, used as a field name in the completions store.
+    # Built from element ids, so renaming an item or a subtask keeps its ticks.
+    return hashlib.sha1("\x1f".join(map(str, parts)).encode()).hexdigest()[:16]
+
+def catalog_frame(structures):
+    rows = []
+    for product, structure in structures.items():
+        for i, (item_id, name, capacity, subtasks) in enumerate(structure['items']):
+            rows.append((product, 'item', i, -1, name, capacity, task_id(product, 'item', item_id or name)))
+            rows += [(product, 'item_subtask', i, j, subtask, np.nan, task_id(product, 'item', item_id or name, subtask_id or subtask)) for j, (subtask_id, subtask) in enumerate(subtasks)]
+        for i, (element_id, name, subtasks) in enumerate(structure['tasks']):
+            rows.append((product, 'task', i, -1, name, np.nan, task_id(product, 'task', element_id or name)))
+            rows += [(product, 'task_subtask', i, j, subtask, np.nan, task_id(product, 'task', element_id or name, subtask_id or subtask)) for j, (subtask_id, subtask) in enumerate(subtasks)]
+    return pd.DataFrame(rows, columns=PLAN_COLUMNS)
+
+def plan_inputs(checklist, products):
+    orders = checklist.dropna(subset=['Produit', 'Quantité'])
+    orders = orders[orders['Produit'].isin(products.keys())]
+    structures = {product: plan_structure(products[product]) for product in orders['Produit'].unique()}
+    digest = hashlib.sha1(pd.util.hash_pandas_object(orders[['Produit', 'Quantité']], index=False).values.tobytes())
+    digest.update(json.dumps(structures, sort_keys=True).encode())
+    return orders, structures, digest.hexdigest()
+
+@st.cache_data(max_entries=64)
+def build_plan(digest, _orders, _structures):
+    # Duplicate order lines for a product are merged, then every item count is computed at once
+    orders = _orders.groupby('Produit', sort=False, as_index=False)['Quantité'].sum()
+    plan = orders.merge(catalog_frame(_structures), on='Produit', how='left')
+    plan[['position', 'subposition']] = plan[['position', 'subposition']].fillna(-1).astype(int)
+    plan['count'] = np.ceil(plan['Quantité'] / plan['capacity']).fillna(0).astype(int)
+    return plan
+
+def day_plan(day):
+    orders, structures, digest = plan_inputs(st.session_state[f'{day}_checklist'], st.session_state.products)
+    return digest, build_plan(digest, orders, structures)
+
+def production_plan(day):
+    return day_plan(day)[1]
 
 def manage_general_todos():
     st.subheader("Gestion des Tâches Générales")
@@ -87,7 +1367,7 @@ def manage_general_todos():
 
     new_todo = st.text_input("Nouvelle tâche générale")
     if st.button("Ajouter une tâche générale") and new_todo:
-        st.session_state[f'{st.session_state.session_key}_general_todos'].append({'task': new_todo, 'active': True})
+        st.session_state[f'{st.session_state.session_key}_general_todos'].append({'_id': ObjectId(), 'task': new_todo, 'active': True})
         save_current_session()
         st.success(f"Tâche '{new_todo}' ajoutée")
         st.rerun()
@@ -106,13 +1386,25 @@ def manage_general_todos():
     
     save_current_session()
 
-def generate_pdf_checklist():
+def pdf_inputs(day, planned=None):
+    # planned is the (digest, plan) pair from day_plan when the caller already has it
+    plan_digest, plan = planned or day_plan(day)
+    todos = [todo['task'] for todo in st.session_state[f'{day}_general_todos'] if todo['active']]
+    digest = hashlib.sha1(json.dumps([day, todos, plan_digest]).encode()).hexdigest()
+    return digest, todos, plan
+
+@st.cache_data(max_entries=32)
+def cached_pdf_checklist(digest, _day, _todos, _plan):
+    return generate_pdf_checklist(_day, _todos, _plan)
+
+@profiled("generate_pdf_checklist")
+def generate_pdf_checklist(day, todos, plan):
     pdf = FPDF()
     pdf.add_page()
     pdf.set_font("Arial", size=12)
     
     pdf.set_font("Arial", 'B', 16)
-    pdf.cell(0, 10, f"Checklist - {st.session_state.session_key}", 0, 1, 'C')
+    pdf.cell(0, 10, f"Checklist - {day}", 0, 1, 'C')
     pdf.ln(10)
     
     pdf.set_font("Arial", 'B', 14)
@@ -120,129 +1412,269 @@ def generate_pdf_checklist():
     pdf.ln(5)
     
     pdf.set_font("Arial", size=12)
-    for todo in st.session_state[f'{st.session_state.session_key}_general_todos']:
-        if todo['active']:
-            pdf.cell(0, 10, f"[ ] {todo['task']}", 0, 1)
+    for todo in todos:
+        pdf.cell(0, 10, f"[ ] {todo}", 0, 1)
     pdf.ln(10)
     
     pdf.set_font("Arial", 'B', 14)
     pdf.cell(0, 10, "Tâches Spécifiques aux Produits", 0, 1)
     pdf.ln(5)
     
-    for _, row in st.session_state[f'{st.session_state.session_key}_checklist'].iterrows():
-        product, quantity = row['Produit'], row['Quantité']
-        if product in st.session_state.products:
-            items_needed = calculate_needed_items(product, quantity)
-            rounded_quantity = math.ceil(quantity)
-            
-            pdf.set_font("Arial", 'B', 12)
-            pdf.cell(0, 10, f"{product} ({rounded_quantity})", 0, 1)
-            
-            pdf.set_font("Arial", size=12)
-            for item in items_needed:
-                pdf.cell(0, 10, f"[ ] {item['count']} {item['name']}", 0, 1)
-                for subtask in item['subtasks']:
-                    pdf.cell(10)
-                    pdf.cell(0, 10, f"[ ] {subtask['name']}", 0, 1)
-            pdf.ln(5)
+    for product, lines in plan.groupby('Produit', sort=False):
+        rounded_quantity = math.ceil(lines['Quantité'].iat[0])
+        
+        pdf.set_font("Arial", 'B', 12)
+        pdf.cell(0, 10, f"{product} ({rounded_quantity})", 0, 1)
+        
+        pdf.set_font("Arial", size=12)
+        for line in lines.itertuples():
+            if line.kind == 'item':
+                pdf.cell(0, 10, f"[ ] {line.count} {line.name}", 0, 1)
+            elif line.kind == 'item_subtask':
+                pdf.cell(10)
+                pdf.cell(0, 10, f"[ ] {line.name}", 0, 1)
+        pdf.ln(5)
     
-    pdf.output("checklist.pdf")
+    return pdf.output(dest='S').encode('latin-1')
+
+# FPDF is pure Python and holds the GIL, so days render one after another on a single
+# worker. Worker processes are not an option: Streamlit runs map.py as __main__, which
+# spawned workers would execute again, Atlas connection included.
+@st.cache_resource
+def pdf_executor():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf")
+
+def render_pdf_bundle(job, inputs):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for day, (todos, plan) in inputs.items():
+            archive.writestr(f"checklist_{day}.pdf", generate_pdf_checklist(day, todos, plan))
+            job['done'] += 1
+    return buffer.getvalue()
+
+def start_pdf_bundle(days):
+    # Inputs are gathered on the script thread, the worker only sees plain data
+    inputs = {day: pdf_inputs(day)[1:] for day in days}
+    job = {'done': 0, 'total': len(inputs), 'started': time.strftime("%H:%M")}
+    job['future'] = pdf_executor().submit(render_pdf_bundle, job, inputs)
+    return job
+
+# The week renders off the script thread while the page stays usable; a fragment
+# polls the job and reruns the page once the bundle is ready
+@st.fragment(run_every=1)
+@profiled_fragment('week_export_progress', logging.DEBUG)
+def render_week_export_progress():
+    job = st.session_state.week_export
+    if not job['future'].done():
+        st.progress(job['done'] / job['total'], text=f"Génération des checklists... ({job['done']}/{job['total']})")
+        return
+    try:
+        job['bundle'] = job['future'].result()
+    except Exception as error:
+        del st.session_state.week_export
+        st.error(f"Échec de la génération des checklists : {error}")
+        return
+    st.rerun()
+
+def render_week_export():
+    if st.button("Exporter la semaine"):
+        # The other days may still be loading in the background
+        for day in DAYS:
+            ensure_day(day)
+        st.session_state.week_export = start_pdf_bundle(DAYS)
 
+    job = st.session_state.get('week_export')
+    if job is None:
+        return
+    if 'bundle' not in job:
+        render_week_export_progress()
+    else:
+        # Not checked against later edits, which would mean digesting every day on each rerun
+        st.download_button(
+            f"Télécharger les checklists de la semaine (générées à {job['started']})",
+            job['bundle'],
+            "checklists_semaine.zip",
+            mime="application/zip",
+            on_click="ignore"
+        )
+
+def render_block_progress(completed_tasks, total_tasks):
+    if total_tasks:
+        st.progress(completed_tasks / total_tasks, text=f"{completed_tasks}/{total_tasks}")
+
+# Checklist blocks are fragments: ticking a box reruns and saves only its block
+@st.fragment
+@profiled_fragment('general_todos_block')
+def render_general_todos_block(day):
+    completions = st.session_state[f'{day}_completions']
+    todos = [todo for todo in st.session_state[f'{day}_general_todos'] if todo['active']]
+
+    for todo in todos:
+        line_id = todo_task_id(todo)
+        done = st.checkbox(todo['task'], value=line_id in completions, key=checkbox_key(day, line_id))
+        if done != (line_id in completions):
+            mark_done(day, line_id, done)
+
+    render_block_progress(sum(todo_task_id(todo) in completions for todo in todos), len(todos))
+
+@st.fragment
+@profiled_fragment('product_block')
+def render_product_block(day, product, lines):
+    completions = st.session_state[f'{day}_completions']
+    st.subheader(f"{product} ({lines['Quantité'].iat[0]})")
+
+    for line in lines.itertuples():
+        if line.kind == 'item':
+            label = f"{line.count} {line.name}"
+        elif line.kind == 'task':
+            if line.position == 0:
+                st.subheader(f"Tâches spécifiques pour {product}")
+            label = line.name
+        elif line.kind in ('item_subtask', 'task_subtask'):
+            label = f"  - {line.name}"
+        else:
+            continue
+
+        done = st.checkbox(label, value=line.task_id in completions, key=checkbox_key(day, line.task_id))
+        if done != (line.task_id in completions):
+            mark_done(day, line.task_id, done)
+
+    lines = lines.dropna(subset=['task_id'])
+    render_block_progress(int(lines['task_id'].isin(completions).sum()), len(lines))
+
+def checklist_progress(day, plan):
+    completions = st.session_state[f'{day}_completions']
+    todo_ids = [todo_task_id(todo) for todo in st.session_state[f'{day}_general_todos'] if todo['active']]
+    line_ids = plan['task_id'].dropna()
+    completed_tasks = int(line_ids.isin(completions).sum()) + sum(line_id in completions for line_id in todo_ids)
+    return completed_tasks, len(line_ids) + len(todo_ids)
+
+@profiled("render_checklist")
 def render_checklist():
     st.header("📋 Checklist - Mise en place")
-    
-    total_tasks = 0
-    completed_tasks = 0
+    day = st.session_state.session_key
 
     # General todos
     st.subheader("Tâches Générales")
-    for todo in st.session_state[f'{st.session_state.session_key}_general_todos']:
-        if todo['active']:
-            todo_key = f"general_todo_{todo['task']}"
-            todo['done'] = st.checkbox(todo['task'], value=todo.get('done', False), key=todo_key)
-            total_tasks += 1
-            if todo['done']:
-                completed_tasks += 1
-
-    # Product-specific tasks
-    for _, row in st.session_state[f'{st.session_state.session_key}_checklist'].iterrows():
-        product, quantity = row['Produit'], row['Quantité']
-        if product in st.session_state.products:
-            st.subheader(f"{product} ({quantity})")
-            
-            # Items and their subtasks
-            items_needed = calculate_needed_items(product, quantity)
-            for item in items_needed:
-                item_key = f"item_{product}_{item['name']}"
-                item['done'] = st.checkbox(f"{item['count']} {item['name']}", value=item.get('done', False), key=item_key)
-                total_tasks += 1
-                if item['done']:
-                    completed_tasks += 1
-                
-                for i, subtask in enumerate(item['subtasks']):
-                    subtask_key = f"{item_key}_subtask_{i}"
-                    subtask['done'] = st.checkbox(f"  - {subtask['name']}", value=subtask.get('done', False), key=subtask_key)
-                    total_tasks += 1
-                    if subtask['done']:
-                        completed_tasks += 1
-            
-            # Product-specific tasks
-            if 'tasks' in st.session_state.products[product]:
-                st.subheader(f"Tâches spécifiques pour {product}")
-                for task in st.session_state.products[product]['tasks']:
-                    task_key = f"task_{product}_{task['name']}"
-                    task['done'] = st.checkbox(task['name'], value=task.get('done', False), key=task_key)
-                    total_tasks += 1
-                    if task['done']:
-                        completed_tasks += 1
-                    
-                    # Render subtasks for each task
-                    if 'subtasks' in task:
-                        for i, subtask in enumerate(task['subtasks']):
-                            subtask_key = f"{task_key}_subtask_{i}"
-                            subtask['done'] = st.checkbox(f"  - {subtask['name']}", value=subtask.get('done', False), key=subtask_key)
-                            total_tasks += 1
-                            if subtask['done']:
-                                completed_tasks += 1
-            
-            st.markdown("---")
+    render_general_todos_block(day)
+
+    # Product-specific tasks; the plan is computed once and shared with the PDF below
+    planned = day_plan(day)
+    plan = planned[1]
+    for product, lines in plan.groupby('Produit', sort=False):
+        render_product_block(day, product, lines)
+        st.markdown("---")
 
-    # Progress bar
+    # Progress bar, refreshed on full reruns; blocks keep their own counters up to date
     st.subheader("Progression")
+    completed_tasks, total_tasks = checklist_progress(day, plan)
     progress_percentage = (completed_tasks / total_tasks) * 100 if total_tasks > 0 else 0
     st.progress(progress_percentage / 100)
     st.write(f"{completed_tasks} tâches terminées sur {total_tasks} ({progress_percentage:.1f}%)")
 
-    # PDF generation
+    # PDF generation, rendered in memory and shared by identical checklists
+    pdf_digest, pdf_todos, pdf_plan = pdf_inputs(day, planned)
     if st.button("Générer PDF"):
-        generate_pdf_checklist()
+        st.session_state[f'{day}_pdf_digest'] = pdf_digest
         st.success("Checklist PDF générée !")
     
-    with open("checklist.pdf", "rb") as f:
-        st.download_button("Télécharger la checklist PDF", f, "checklist.pdf")
+    if st.session_state.get(f'{day}_pdf_digest') == pdf_digest:
+        st.download_button(
+            "Télécharger la checklist PDF",
+            cached_pdf_checklist(pdf_digest, day, pdf_todos, pdf_plan),
+            f"checklist_{day}.pdf",
+            mime="application/pdf"
+        )
+
+    render_week_export()
 
     # Save the current state
     save_current_session()
 
+# Weekly volumes are computed by the server from what has been flushed, per product
+# first so duplicate order lines are merged exactly like in the checklist.
+WEEKLY_REPORT_PIPELINE = [
+    {'$match': {'session_key': {'$in': DAYS}}},
+    {'$unwind': '$items'},
+    {'$match': {'items.Quantité': {'$gt': 0}}},
+    {'$group': {'_id': {'day': '$session_key', 'product': '$items.Produit'}, 'quantity': {'$sum': '$items.Quantité'}}},
+    {'$lookup': {'from': 'products', 'localField': '_id.product', 'foreignField': 'name', 'as': 'product'}},
+    {'$unwind': '$product'},
+    {'$match': {'product.deleted': {'$ne': True}}},
+    {'$facet': {
+        'containers': [
+            {'$unwind': '$product.items'},
+            {'$match': {'product.items.capacity': {'$gt': 0}}},
+            {'$group': {
+                '_id': {'day': '$_id.day', 'item': '$product.items.name'},
+                'count': {'$sum': {'$ceil': {'$divide': ['$quantity', '$product.items.capacity']}}}
+            }}
+        ],
+        'tasks': [
+            {'$group': {
+                '_id': '$_id.day',
+                'products': {'$sum': 1},
+                'quantity': {'$sum': '$quantity'},
+                'tasks': {'$sum': {'$size': {'$ifNull': ['$product.tasks', []]}}}
+            }}
+        ]
+    }}
+]
+
+@st.cache_data(max_entries=8)
+def weekly_report(checklists_revision, products_revision):
+    # Keyed on the revisions only: the report is recomputed once either collection changes
+    result = next(db.checklists.aggregate(WEEKLY_REPORT_PIPELINE), {'containers': [], 'tasks': []})
+    containers = pd.DataFrame(
+        [(row['_id']['item'], row['_id']['day'], int(row['count'])) for row in result['containers']],
+        columns=['Élément', 'Jour', 'Nombre']
+    ).pivot_table(index='Élément', columns='Jour', values='Nombre', aggfunc='sum', fill_value=0)
+    containers = containers.reindex(columns=[day for day in DAYS if day in containers.columns])
+    containers['Total'] = containers.sum(axis=1)
+    tasks = pd.DataFrame(
+        [(row['_id'], row['products'], row['quantity'], row['tasks']) for row in result['tasks']],
+        columns=['Jour', 'Produits', 'Quantité', 'Tâches']
+    ).set_index('Jour').reindex(DAYS).fillna(0).astype(int)
+    return containers.sort_values('Total', ascending=False), tasks
+
+@profiled("render_weekly_report")
+def render_weekly_report():
+    st.header("📊 Rapport de la semaine")
+    st.caption("Calculé à partir des commandes enregistrées")
+    revisions = current_revisions()
+    containers, tasks = weekly_report(revisions.get('checklists', 0), revisions.get('products', 0))
+
+    st.subheader("Contenants par jour")
+    if containers.empty:
+        st.write("Aucune commande cette semaine.")
+    else:
+        st.dataframe(containers, width="stretch")
+
+    st.subheader("Volume par jour")
+    st.dataframe(tasks, width="stretch")
+
 def add_task_to_product(product_name, task_name):
     if product_name in st.session_state.products:
-        if 'tasks' not in st.session_state.products[product_name]:
-            st.session_state.products[product_name]['tasks'] = []
+        product = edit_product(product_name)
+        if 'tasks' not in product:
+            product['tasks'] = []
         
-        st.session_state.products[product_name]['tasks'].append({
+        product['tasks'].append({
+            'id': new_element_id(),
             'name': task_name,
-            'subtasks': [],
-            'done': False
+            'subtasks': []
         })
         save_current_session()
         st.success(f"Task '{task_name}' added to {product_name}")
     else:
         st.error(f"Product '{product_name}' not found")
 
+@profiled("manage_products")
 def manage_products():
-    product_to_edit = st.selectbox(
+    product_to_edit = product_picker(
         "Sélectionnez un produit à modifier:",
-        list(st.session_state.products.keys()) + ["Ajouter un nouveau produit"]
+        "product_to_edit",
+        trailing_options=["Ajouter un nouveau produit"]
     )
 
     if product_to_edit == "Ajouter un nouveau produit":
@@ -254,9 +1686,10 @@ def manage_products():
             st.rerun()
 
     elif product_to_edit in st.session_state.products:
+        product = edit_product(product_to_edit)
         st.subheader(f"Modification de '{product_to_edit}'")
 
-        for i, item in enumerate(st.session_state.products[product_to_edit]["items"]):
+        for i, item in enumerate(product["items"]):
             col1, col2, col3 = st.columns([2, 1, 1])
             with col1:
                 new_name = st.text_input(f"Nom de l'élément {i+1}", item["name"], key=f"name_{i}")
@@ -264,7 +1697,7 @@ def manage_products():
                 new_capacity = st.number_input(f"Capacité de l'élément {i+1}", min_value=1, value=item["capacity"], key=f"capacity_{i}")
             with col3:
                 if st.button("Supprimer l'élément", key=f"remove_item_{i}"):
-                    st.session_state.products[product_to_edit]["items"].pop(i)
+                    product["items"].pop(i)
                     save_current_session()
                     st.rerun()
 
@@ -272,7 +1705,7 @@ def manage_products():
             for j, subtask in enumerate(item["subtasks"]):
                 col1, col2 = st.columns([3, 1])
                 with col1:
-                    subtask_name = st.text_input(f"Nom de la sous-tâche {j+1}", subtask["name"], key=f"subtask_name_{i}_{j}")
+                    subtask["name"] = st.text_input(f"Nom de la sous-tâche {j+1}", subtask["name"], key=f"subtask_name_{i}_{j}")
                 with col2:
                     if st.button("Supprimer la sous-tâche", key=f"remove_subtask_{i}_{j}"):
                         item["subtasks"].pop(j)
@@ -281,16 +1714,15 @@ def manage_products():
 
             new_subtask = st.text_input(f"Nouvelle sous-tâche pour l'élément {item['name']}", key=f"new_subtask_{i}")
             if st.button(f"Ajouter une sous-tâche à {item['name']}", key=f"add_subtask_{i}") and new_subtask:
-                item["subtasks"].append({"name": new_subtask, "done": False})
+                item["subtasks"].append({"id": new_element_id(), "name": new_subtask})
                 save_current_session()
                 st.success(f"Sous-tâche '{new_subtask}' ajoutée à '{item['name']}'")
                 st.rerun()
 
-            st.session_state.products[product_to_edit]["items"][i] = {
+            product["items"][i] = {
+                **item,
                 "name": new_name,
-                "capacity": new_capacity,
-                "subtasks": item["subtasks"],
-                "done": item.get("done", False)
+                "capacity": new_capacity
             }
 
             st.markdown("---")
@@ -298,11 +1730,11 @@ def manage_products():
         new_item_name = st.text_input("Nom du nouvel élément")
         new_item_capacity = st.number_input("Capacité du nouvel élément", min_value=1, value=1)
         if st.button("Ajouter un élément") and new_item_name:
-            st.session_state.products[product_to_edit]["items"].append({
+            product["items"].append({
+                "id": new_element_id(),
                 "name": new_item_name,
                 "capacity": new_item_capacity,
-                "subtasks": [],
-                "done": False
+                "subtasks": []
             })
             save_current_session()
             st.success(f"Ajouté {new_item_name} à {product_to_edit}")
@@ -310,16 +1742,16 @@ def manage_products():
 
 # New task management section
         st.subheader("Tâches du produit")
-        if "tasks" not in st.session_state.products[product_to_edit]:
-            st.session_state.products[product_to_edit]["tasks"] = []
+        if "tasks" not in product:
+            product["tasks"] = []
 
-        for i, task in enumerate(st.session_state.products[product_to_edit]["tasks"]):
+        for i, task in enumerate(product["tasks"]):
             col1, col2 = st.columns([3, 1])
             with col1:
                 task_name = st.text_input(f"Nom de la tâche {i+1}", task["name"], key=f"task_name_{i}")
             with col2:
                 if st.button("Supprimer la tâche", key=f"remove_task_{i}"):
-                    st.session_state.products[product_to_edit]["tasks"].pop(i)
+                    product["tasks"].pop(i)
                     save_current_session()
                     st.rerun()
 
@@ -327,7 +1759,7 @@ def manage_products():
             for j, subtask in enumerate(task["subtasks"]):
                 col1, col2 = st.columns([3, 1])
                 with col1:
-                    subtask_name = st.text_input(f"Nom de la sous-tâche {j+1}", subtask["name"], key=f"task_subtask_name_{i}_{j}")
+                    subtask["name"] = st.text_input(f"Nom de la sous-tâche {j+1}", subtask["name"], key=f"task_subtask_name_{i}_{j}")
                 with col2:
                     if st.button("Supprimer la sous-tâche", key=f"remove_task_subtask_{i}_{j}"):
                         task["subtasks"].pop(j)
@@ -336,15 +1768,14 @@ def manage_products():
 
             new_subtask = st.text_input(f"Nouvelle sous-tâche pour la tâche {task['name']}", key=f"new_task_subtask_{i}")
             if st.button(f"Ajouter une sous-tâche à {task['name']}", key=f"add_task_subtask_{i}") and new_subtask:
-                task["subtasks"].append({"name": new_subtask, "done": False})
+                task["subtasks"].append({"id": new_element_id(), "name": new_subtask})
                 save_current_session()
                 st.success(f"Sous-tâche '{new_subtask}' ajoutée à la tâche '{task['name']}'")
                 st.rerun()
 
-            st.session_state.products[product_to_edit]["tasks"][i] = {
-                "name": task_name,
-                "subtasks": task["subtasks"],
-                "done": task.get("done", False)
+            product["tasks"][i] = {
+                **task,
+                "name": task_name
             }
 
             st.markdown("---")
@@ -352,10 +1783,10 @@ def manage_products():
         # New task addition
         new_task_name = st.text_input("Nom de la nouvelle tâche")
         if st.button("Ajouter une tâche") and new_task_name:
-            st.session_state.products[product_to_edit]["tasks"].append({
+            product["tasks"].append({
+                "id": new_element_id(),
                 "name": new_task_name,
-                "subtasks": [],
-                "done": False
+                "subtasks": []
             })
             save_current_session()
             st.success(f"Ajouté la tâche {new_task_name} à {product_to_edit}")
@@ -363,7 +1794,7 @@ def manage_products():
 
 def duplicate_product():
     st.subheader("Dupliquer le Produit")
-    product_to_duplicate = st.selectbox("Sélectionnez un produit à dupliquer:", list(st.session_state.products.keys()))
+    product_to_duplicate = product_picker("Sélectionnez un produit à dupliquer:", "product_to_duplicate")
     new_product_name = st.text_input("Entrez le nouveau nom du produit dupliqué:")
 
     if st.button("Dupliquer le Produit") and new_product_name and product_to_duplicate:
@@ -371,7 +1802,7 @@ def duplicate_product():
             st.error(f"Un produit nommé '{new_product_name}' existe déjà.")
         else:
             # Create a new copy of the product without the '_id' field
-            new_product = {k: v for k, v in st.session_state.products[product_to_duplicate].items() if k != '_id'}
+            new_product = {k: copy.deepcopy(v) for k, v in st.session_state.products[product_to_duplicate].items() if k not in ('_id', 'revision')}
             new_product['name'] = new_product_name
             st.session_state.products[new_product_name] = new_product
             save_current_session()
@@ -379,35 +1810,316 @@ def duplicate_product():
             st.rerun()
 
     st.subheader("Supprimer un produit")
-    product_to_delete = st.selectbox("Sélectionnez un produit à supprimer", [""] + list(st.session_state.products.keys()))
+    product_to_delete = product_picker("Sélectionnez un produit à supprimer", "product_to_delete", leading_options=[""])
     if product_to_delete and st.button(f"Supprimer {product_to_delete}"):
         del st.session_state.products[product_to_delete]
         save_current_session()
         st.success(f"Produit '{product_to_delete}' supprimé")
         st.experimental_rerun()
 
+# Bulk import and export. Files are read chunk by chunk and every row is checked
+# before anything is written; rows then go through the usual saves, so the write
+# queue sends them as a handful of bulk writes.
+def csv_encoding(uploaded_file):
+    # Excel saves CSV as UTF-8 with a BOM or as cp1252; the file is decoded in blocks
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for block in iter(lambda: uploaded_file.read(1 << 16), b''):
+            decoder.decode(block)
+        decoder.decode(b'', final=True)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'cp1252'
+    finally:
+        uploaded_file.seek(0)
+
+def record_chunks(uploaded_file):
+    # Yields lists of (line, record); CSV and NDJSON files are never loaded whole
+    name = uploaded_file.name.lower()
+    uploaded_file.seek(0)
+    if name.endswith('.csv'):
+        line = 2
+        encoding = csv_encoding(uploaded_file)
+        for frame in pd.read_csv(uploaded_file, sep=None, engine='python', chunksize=IMPORT_CHUNK_ROWS, dtype=str, keep_default_na=False, encoding=encoding):
+            records = frame.to_dict(orient='records')
+            yield list(enumerate(records, line))
+            line += len(records)
+    elif name.endswith(('.ndjson', '.jsonl')):
+        chunk = []
+        for line, text in enumerate(uploaded_file, 1):
+            if not text.strip():
+                continue
+            try:
+                chunk.append((line, json.loads(text)))
+            except ValueError:
+                chunk.append((line, None))
+            if len(chunk) == IMPORT_CHUNK_ROWS:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    else:
+        records = json.load(uploaded_file)
+        if isinstance(records, dict):
+            records = [records]
+        for start in range(0, len(records), IMPORT_CHUNK_ROWS):
+            yield list(enumerate(records[start:start + IMPORT_CHUNK_ROWS], start + 1))
+
+def positive_integer(value, message):
+    try:
+        number = float(str(value).replace(',', '.'))
+    except ValueError:
+        raise ValueError(message)
+    if number < 1 or not number.is_integer():
+        raise ValueError(message)
+    return int(number)
+
+def order_row(record, default_day):
+    if not isinstance(record, dict):
+        raise ValueError("ligne illisible")
+    day = str(record.get('Jour') or default_day).strip().upper()
+    if day not in DAYS:
+        raise ValueError(f"jour inconnu : {day}")
+    product = str(record.get('Produit') or '').strip()
+    if product not in st.session_state.products:
+        suggestion = search_products(product, 1) if product else []
+        raise ValueError(f"produit inconnu : {product}" + (f" (vouliez-vous dire {suggestion[0]} ?)" if suggestion else ""))
+    return day, product, positive_integer(record.get('Quantité', ''), "quantité invalide")
+
+def catalog_product(record):
+    # {"name", "items": [{"name", "capacity", "subtasks"}], "tasks": [{"name", "subtasks"}]},
+    # subtasks given as names or as {"name"}
+    if not isinstance(record, dict) or not str(record.get('name') or '').strip():
+        raise ValueError("nom de produit manquant")
+
+    def subtasks(element):
+        return [{'name': str(subtask['name'] if isinstance(subtask, dict) else subtask).strip()} for subtask in element.get('subtasks', [])]
+
+    items = []
+    for item in record.get('items', []):
+        capacity = positive_integer(item.get('capacity', ''), f"capacité invalide pour {item.get('name')}")
+        items.append({'name': str(item['name']).strip(), 'capacity': capacity, 'subtasks': subtasks(item)})
+    tasks = [{'name': str(task['name']).strip(), 'subtasks': subtasks(task)} for task in record.get('tasks', [])]
+    return {'name': str(record['name']).strip(), 'items': items, 'tasks': tasks}
+
+def add_catalog_row(products, record):
+    # CSV catalogs have one row per element or subtask:
+    # Produit, Type (élément or tâche), Élément, Capacité, Sous-tâche
+    product_name = str(record.get('Produit') or '').strip()
+    element_name = str(record.get('Élément') or '').strip()
+    if not product_name or not element_name:
+        raise ValueError("produit ou élément manquant")
+    kind = normalize(record.get('Type') or '').strip()
+    if kind not in ('element', 'tache'):
+        raise ValueError(f"type inconnu : {record.get('Type')}")
+
+    product = products.get(product_name, {'name': product_name, 'items': [], 'tasks': []})
+    elements = product['items' if kind == 'element' else 'tasks']
+    element = next((element for element in elements if element['name'] == element_name), None)
+    if element is None:
+        element = {'name': element_name, 'subtasks': []}
+        if kind == 'element':
+            element['capacity'] = positive_integer(record.get('Capacité', ''), f"capacité invalide pour {element_name}")
+        elements.append(element)
+    products[product_name] = product
+    subtask = str(record.get('Sous-tâche') or '').strip()
+    if subtask:
+        element['subtasks'].append({'name': subtask})
+
+def reuse_element_ids(product_data, previous):
+    # Elements keep the id of the element of the same name, so their ticks survive a re-import
+    for key in ('items', 'tasks'):
+        previous_elements = {element['name']: element for element in previous.get(key, [])}
+        for element in product_data[key]:
+            match = previous_elements.get(element['name'])
+            if match is None or 'id' not in match:
+                continue
+            element['id'] = match['id']
+            previous_subtasks = {subtask['name']: subtask['id'] for subtask in match.get('subtasks', []) if 'id' in subtask}
+            for subtask in element['subtasks']:
+                if subtask['name'] in previous_subtasks:
+                    subtask['id'] = previous_subtasks[subtask['name']]
+    assign_element_ids(product_data)
+
+def import_progress(progress, uploaded_file, text):
+    progress.progress(min(1.0, uploaded_file.tell() / max(uploaded_file.size, 1)), text=text)
+
+def report_import(imported, errors, what):
+    st.success(f"{imported} {what} importé(s)")
+    if errors:
+        st.warning(f"{len(errors)} ligne(s) ignorée(s)")
+        st.dataframe(pd.DataFrame(errors[:50], columns=['Ligne', 'Problème']), hide_index=True)
+
+def import_orders(uploaded_file, replace):
+    progress = st.progress(0.0, text="Lecture des commandes...")
+    imported = {day: [] for day in DAYS}
+    errors = []
+    try:
+        for chunk in record_chunks(uploaded_file):
+            for line, record in chunk:
+                try:
+                    day, product, quantity = order_row(record, st.session_state.session_key)
+                except ValueError as error:
+                    errors.append((line, str(error)))
+                    continue
+                imported[day].append({'Produit': product, 'Quantité': quantity})
+            import_progress(progress, uploaded_file, f"{sum(map(len, imported.values()))} commande(s) valides")
+    except UNREADABLE_FILE_ERRORS as error:
+        st.error(f"Fichier illisible, rien n'a été importé : {error}")
+        return
+
+    if errors and not any(imported.values()):
+        st.error(f"Aucune commande valide, rien n'a été importé ({len(errors)} ligne(s) rejetée(s))")
+        st.dataframe(pd.DataFrame(errors[:50], columns=['Ligne', 'Problème']), hide_index=True)
+        return
+
+    # One frame update per day; appended rows leave as a single $push. Replacing only
+    # touches the days present in the file, the others keep their orders.
+    for day, rows in imported.items():
+        if not rows:
+            continue
+        ensure_day(day)
+        new_rows = pd.DataFrame(rows, columns=['Produit', 'Quantité'])
+        if not replace:
+            new_rows = pd.concat([st.session_state[f'{day}_checklist'], new_rows], ignore_index=True)
+        st.session_state[f'{day}_checklist'] = new_rows
+        save_checklist(day)
+    flush_writes()
+    report_import(sum(map(len, imported.values())), errors, "commande(s)")
+
+def import_catalog(uploaded_file):
+    progress = st.progress(0.0, text="Lecture du catalogue...")
+    products = {}
+    errors = []
+    csv_rows = uploaded_file.name.lower().endswith('.csv')
+    try:
+        for chunk in record_chunks(uploaded_file):
+            for line, record in chunk:
+                try:
+                    if csv_rows:
+                        add_catalog_row(products, record)
+                    else:
+                        product_data = catalog_product(record)
+                        if product_data['name'] in products:
+                            raise ValueError(f"produit en double : {product_data['name']}")
+                        products[product_data['name']] = product_data
+                except (ValueError, KeyError, TypeError, AttributeError) as error:
+                    errors.append((line, str(error) if isinstance(error, ValueError) else "ligne illisible"))
+            import_progress(progress, uploaded_file, f"{len(products)} produit(s) valides")
+    except UNREADABLE_FILE_ERRORS as error:
+        st.error(f"Fichier illisible, rien n'a été importé : {error}")
+        return
+
+    names = list(products)
+    for start in range(0, len(names), IMPORT_CHUNK_ROWS):
+        chunk_names = names[start:start + IMPORT_CHUNK_ROWS]
+        for product_name in chunk_names:
+            reuse_element_ids(products[product_name], st.session_state.products.get(product_name, {}))
+            st.session_state.products[product_name] = products[product_name]
+        save_products(chunk_names)
+    flush_writes()
+    report_import(len(products), errors, "produit(s)")
+
+# Documents are matched on the field the app looks them up by, _id only for todos
+RESTORE_FIELDS = {'products': 'name', 'checklists': 'session_key', 'general_todos': '_id', 'completions': 'session_key'}
+
+def export_dataset():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for collection in SYNCED_COLLECTIONS:
+            # Documents go from the cursor straight into the archive, one line each
+            with archive.open(f"{collection}.ndjson", "w") as f:
+                for document in db[collection].find().batch_size(EXPORT_BATCH_SIZE):
+                    f.write(json_util.dumps(document).encode() + b"\n")
+    return buffer.getvalue()
+
+def restore_dataset(uploaded_file):
+    progress = st.progress(0.0, text="Restauration...")
+    restored = 0
+    errors = []
+    try:
+        with zipfile.ZipFile(uploaded_file) as archive:
+            collections = [collection for collection in SYNCED_COLLECTIONS if f"{collection}.ndjson" in archive.namelist()]
+            for position, collection in enumerate(collections, 1):
+                field = RESTORE_FIELDS[collection]
+                entries = []
+                with archive.open(f"{collection}.ndjson") as f:
+                    for line, text in enumerate(f, 1):
+                        try:
+                            document = json_util.loads(text)
+                            key = document[field]
+                        except (ValueError, KeyError, TypeError):
+                            errors.append((f"{collection}:{line}", "ligne illisible"))
+                            continue
+                        # Revisions are stamped again when the queue flushes
+                        document = {k: v for k, v in document.items() if k != 'revision' and (k != '_id' or field == '_id')}
+                        # Keyed apart from the app's own entries, which pending_ticks and others read
+                        entries.append((('restore', collection, key), {'collection': collection, 'op': 'replace', 'filter': {field: key}, 'document': document, 'upsert': True, 'revision': True}))
+                        if len(entries) == IMPORT_CHUNK_ROWS:
+                            enqueue_writes(entries)
+                            restored += len(entries)
+                            entries = []
+                enqueue_writes(entries)
+                restored += len(entries)
+                progress.progress(position / len(collections), text=f"{collection} : {restored} document(s)")
+    except zipfile.BadZipFile as error:
+        # Documents already queued are still written
+        flush_writes()
+        st.error(f"Sauvegarde illisible : {error}")
+        if restored:
+            st.warning(f"{restored} document(s) restauré(s) avant l'erreur")
+        return
+    flush_writes()
+    report_import(restored, errors, "document(s)")
+
+def render_import_export():
+    st.subheader("Importer des commandes")
+    st.caption("CSV ou JSON avec les colonnes Produit, Quantité et, si besoin, Jour")
+    orders_file = st.file_uploader("Fichier de commandes", type=["csv", "json", "ndjson", "jsonl"], key="orders_file")
+    replace_orders = st.checkbox("Remplacer les commandes des jours présents dans le fichier", key="replace_orders")
+    if orders_file is not None and st.button("Importer les commandes"):
+        import_orders(orders_file, replace_orders)
+
+    st.subheader("Importer un catalogue")
+    st.caption("CSV avec les colonnes Produit, Type (élément ou tâche), Élément, Capacité, Sous-tâche, ou JSON de produits")
+    catalog_file = st.file_uploader("Fichier de catalogue", type=["csv", "json", "ndjson", "jsonl"], key="catalog_file")
+    if catalog_file is not None and st.button("Importer le catalogue"):
+        import_catalog(catalog_file)
+
+    st.subheader("Sauvegarde")
+    if st.button("Exporter toutes les données"):
+        st.session_state.dataset_export = export_dataset()
+    if 'dataset_export' in st.session_state:
+        st.download_button("Télécharger la sauvegarde", st.session_state.dataset_export, "mazette_sauvegarde.zip", mime="application/zip")
+
+    backup_file = st.file_uploader("Restaurer une sauvegarde", type=["zip"], key="backup_file")
+    confirm = st.checkbox("Écraser les documents qui existent aussi dans la sauvegarde (les autres sont conservés)", key="confirm_restore")
+    if backup_file is not None and confirm and st.button("Restaurer"):
+        restore_dataset(backup_file)
+
 def main():
     if 'session_key' not in st.session_state:
         st.session_state.session_key = "LUNDI"
 
     with st.sidebar:
-        session_key = st.selectbox("Sélectionnez le jour:", ["LUNDI", "MARDI", "JEUDI", "VENDREDI"], key="day_selector")
+        session_key = st.selectbox("Sélectionnez le jour:", DAYS, key="day_selector")
 
     if session_key != st.session_state.session_key:
         st.session_state.session_key = session_key
 
     set_theme(st.session_state.session_key)
+    schema_bootstrap()
     init_session()  # Call init_session() here
 
     st.title(f"{st.session_state.session_key}")
 
     with st.sidebar:
         st.header("Gestion")
-        menu_choice = st.radio("", ["Commandes", "Gestion des Tâches Générales", "Gestion des Produits", "Dupliquer le Produit"])
+        menu_choice = st.radio("", ["Commandes", "Gestion des Tâches Générales", "Gestion des Produits", "Dupliquer le Produit", "Import / Export"])
 
         if menu_choice == "Commandes":
             st.subheader("Ajouter aux commandes")
-            new_product = st.selectbox("Sélectionnez un produit:", list(st.session_state.products.keys()))
+            new_product = product_picker("Sélectionnez un produit:", "order_product_sidebar")
             new_quantity = st.number_input("Entrez la quantité:", min_value=1, value=1, step=1)
             if st.button("Ajouter aux commandes"):
                 new_row = pd.DataFrame({'Produit': [new_product], 'Quantité': [new_quantity]})
@@ -436,13 +2148,29 @@ def main():
         elif menu_choice == "Dupliquer le Produit":
             duplicate_product()
 
-    tabs = st.sidebar.radio("Navigation", ["Checklist", "Commandes", "Gestion des Produits", "Tâches Générales"])
+        elif menu_choice == "Import / Export":
+            render_import_export()
+
+    tabs = st.sidebar.radio("Navigation", ["Checklist", "Commandes", "Gestion des Produits", "Tâches Générales", "Rapport de la semaine"])
+
+    # Pending writes are sent right away when the user changes day or page
+    navigation = (st.session_state.session_key, menu_choice, tabs)
+    if st.session_state.get('navigation') != navigation:
+        st.session_state.navigation = navigation
+        flush_writes()
+
+    with st.sidebar:
+        render_write_status()
+        watch_remote_changes()
+        if debug_enabled():
+            render_debug_panel()
+            render_schema_panel()
 
     if tabs == "Checklist":
         render_checklist()
     elif tabs == "Commandes":
         st.subheader("Ajouter aux commandes")
-        new_product = st.selectbox("Sélectionnez un produit:", list(st.session_state.products.keys()))
+        new_product = product_picker("Sélectionnez un produit:", "order_product")
         new_quantity = st.number_input("Entrez la quantité:", min_value=1, value=1, step=1)
         if st.button("Ajouter aux commandes"):
             new_row = pd.DataFrame({'Produit': [new_product], 'Quantité': [new_quantity]})
@@ -465,6 +2193,9 @@ def main():
         manage_products()
     elif tabs == "Tâches Générales":
         manage_general_todos()
+    elif tabs == "Rapport de la semaine":
+        render_weekly_report()
 
 if __name__ == "__main__":
-    main()
+    with profiled_run(measure_bytes=debug_enabled()):
+        main()